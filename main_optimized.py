@@ -46,13 +46,7 @@ def main():
         if cmd == "reset":
             session.clear()
             # Clear memory files too
-            import json
-            for f in session.memory_dir.iterdir():
-                if f.is_file() and not f.name.startswith("."):
-                    try:
-                        f.unlink()
-                    except:
-                        pass
+            session.clear_memory_files()
             print("✓ Session and memory cleared.")
             continue
         
@@ -90,7 +84,7 @@ def main():
                 print("\n🤖 Assistant: ", end="", flush=True)
                 streamed_any["v"] = True
             print(chunk, end="", flush=True)
-        response = general_product_qna(query=user_input, session_id=session_id, stream_callback=on_chunk)
+        response = general_product_qna(query=user_input, session_id=session_id, stream_callback=on_chunk, session=session)
         elapsed = time.perf_counter() - start
         
         # If nothing was streamed (e.g., tool disabled or short response), print the full answer now
@@ -37,14 +37,35 @@ ARCHITECTURE:
 8. Layer 2 Response Generation
 """
 
+import io
 import os
 import re
+import sys
 import json
 import time
+import uuid
+import hashlib
+import string
 import logging
-from typing import Optional, List, Dict, Any, Tuple, Callable, Set
+import functools
+import importlib.util
+import heapq
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Tuple, Callable, Set, Iterable, Union
 from pathlib import Path
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields, MISSING
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # =============================================================================
 # LOGGING SETUP
@@ -86,6 +107,7 @@ class Config:
     # Pinecone
     PINECONE_INDEX: str = field(default_factory=lambda: os.getenv("PINECONE_INDEX") or os.getenv("PINECONE_INDEX_NAME", ""))
     PINECONE_NAMESPACE: Optional[str] = field(default_factory=lambda: os.getenv("PINECONE_NAMESPACE"))
+    PINECONE_USE_GRPC: bool = field(default_factory=lambda: os.getenv("PINECONE_USE_GRPC", "true").lower() == "true")
     
     # Models
     ROUTER_MODEL: str = field(default_factory=lambda: os.getenv("LLM_MODEL_ROUTER", "claude-haiku-4-5-20251001"))
@@ -104,10 +126,17 @@ class Config:
     DEBUG_MODE: bool = field(default_factory=lambda: os.getenv("DEBUG_MODE", "false").lower() == "true")
     STREAM_FINAL_ONLY: bool = field(default_factory=lambda: os.getenv("STREAM_FINAL_ONLY", "false").lower() == "true")
     COMPARE_TOP_K_PER_ENTITY: int = field(default_factory=lambda: int(os.getenv("COMPARE_TOP_K_PER_ENTITY", 20)))
+    DISABLE_GROUPING_AND_AGGREGATION: bool = field(default_factory=lambda: os.getenv("DISABLE_GROUPING_AND_AGGREGATION", "true").lower() == "true")
+    ENABLE_INTENT_CACHE: bool = field(default_factory=lambda: os.getenv("ENABLE_INTENT_CACHE", "true").lower() == "true")
+    INTENT_CACHE_THRESHOLD: float = field(default_factory=lambda: float(os.getenv("INTENT_CACHE_THRESHOLD", 0.95)))
+    INTENT_CACHE_MAX_ENTRIES: int = field(default_factory=lambda: int(os.getenv("INTENT_CACHE_MAX_ENTRIES", 1000)))
+    ENABLE_SPECULATIVE_RETRIEVAL: bool = field(default_factory=lambda: os.getenv("ENABLE_SPECULATIVE_RETRIEVAL", "true").lower() == "true")
     
     # Limits
     MAX_MEMORY_FILE_SIZE: int = field(default_factory=lambda: int(os.getenv("MAX_MEMORY_FILE_SIZE", 1024 * 100)))
     MAX_TOOL_ITERATIONS: int = field(default_factory=lambda: int(os.getenv("MAX_TOOL_ITERATIONS", 8)))
+    MAX_MEMORY_AGENT_TEXTS: int = field(default_factory=lambda: int(os.getenv("MAX_MEMORY_AGENT_TEXTS", 4)))
+    STREAM_IDLE_TIMEOUT: float = field(default_factory=lambda: float(os.getenv("STREAM_IDLE_TIMEOUT", 60)))
     
     def validate(self) -> List[str]:
         """Return list of missing required configs."""
@@ -160,6 +189,18 @@ MAX_CHUNKS_PER_PRODUCT = 3
 #            Provides good variety without overwhelming the response
 MAX_PRODUCTS_FOR_LLM = 20
 
+# Max concurrent per-entity Pinecone queries in compare mode
+# RATIONALE: Each query is a network round-trip (I/O bound), so threads overlap them
+COMPARE_MAX_WORKERS = 8
+
+# Max cached query embeddings (LRU)
+# RATIONALE: The same text is often embedded repeatedly within a session; ~2048 x 1536 floats stays small
+EMBED_CACHE_MAX_ENTRIES = 2048
+
+# Min merged result count before sorting via numpy argsort
+# RATIONALE: Below this, array setup costs more than list.sort's per-item key calls
+NUMPY_SORT_MIN_ITEMS = 64
+
 # Max products for web validation
 # NEW in v3.2
 # RATIONALE: 10 products keeps web search focused and fast
@@ -173,6 +214,15 @@ MAX_PRODUCTS_FOR_WEB_VALIDATION = 10
 # RATIONALE: Memory announcements are typically short
 META_TEXT_THRESHOLD = 160
 
+# Prompt template files are re-stat'ed only every N reads
+# RATIONALE: Templates never change in production; edits are still picked up without restart
+PROMPT_MTIME_CHECK_EVERY = 50
+
+# Exact-repeat intent cache: (session_id, turn, query) results kept this long / this many
+# RATIONALE: Streamlit reruns can re-submit the same query seconds later; per-turn so follow-ups never reuse a stale intent
+INTENT_TTL_SECONDS = 60
+INTENT_TTL_MAX_ENTRIES = 256
+
 # Session files
 SESSION_STATE_FILE = "session_state.json"
 LIST_INDEX_FILE = "list_index.json"
@@ -203,6 +253,15 @@ META_MARKER_PATTERN = re.compile(
     re.IGNORECASE
 )
 
+# Literal openers META_MARKER_PATTERN can start with (lowercase); a cheap startswith gate
+# lets the common non-meta text skip the regex entirely
+_META_LEADING_WORDS = ("i'll", "i've", "i will", "i have", "let me", "saving", "updating", "checking", "recording", "noting")
+
+
+def _has_meta_marker(text: str) -> bool:
+    """Equivalent to META_MARKER_PATTERN.search(text), with a prefix pre-check."""
+    return text[:10].lower().startswith(_META_LEADING_WORDS) and META_MARKER_PATTERN.search(text) is not None
+
 # Additional patterns for stripping preamble from start of response
 PREAMBLE_STRIP_PATTERNS = [
     re.compile(r"^I'll save this.*?(?:and then |then |\.)\s*", re.IGNORECASE),
@@ -224,7 +283,7 @@ def is_meta_only_text(text: str) -> bool:
     if not text or not text.strip():
         return True
     text = text.strip()
-    if len(text) <= META_TEXT_THRESHOLD and META_MARKER_PATTERN.search(text):
+    if len(text) <= META_TEXT_THRESHOLD and _has_meta_marker(text):
         return True
     return False
 
@@ -251,7 +310,7 @@ def extract_meaningful_text(text: str) -> str:
     if not text:
         return ""
     sentences = re.split(r'(?<=[.!?])\s+', text)
-    meaningful = [s for s in sentences if not META_MARKER_PATTERN.search(s)]
+    meaningful = [s for s in sentences if not _has_meta_marker(s)]
     return " ".join(meaningful).strip()
 
 
@@ -279,14 +338,55 @@ def validate_query(query: str) -> Tuple[bool, str]:
     return True, query
 
 
+# =============================================================================
+# JSON HELPERS
+# =============================================================================
+
+def _json_loads(text: str) -> Any:
+    """Parse JSON with orjson (C-backed) when installed, else stdlib json.
+    
+    orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either.
+    """
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def _json_dumps(obj: Any, pretty: bool = False) -> str:
+    """Serialize to a JSON string (UTF-8, not ASCII-escaped); compact unless pretty.
+    
+    Uses orjson when installed and falls back to stdlib json for values orjson rejects.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        try:
+            return orjson.dumps(obj, option=option).decode("utf-8")
+        except TypeError:
+            pass
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
 # =============================================================================
 # CLIENT INITIALIZATION
 # =============================================================================
 
-from anthropic import Anthropic
-from openai import OpenAI
+import httpx
+from anthropic import Anthropic, APITimeoutError, DefaultHttpxClient as AnthropicHttpxClient
+from openai import OpenAI, DefaultHttpxClient as OpenAIHttpxClient
 from pinecone import Pinecone
 
+try:
+    from pinecone.grpc import PineconeGRPC
+except ImportError:
+    PineconeGRPC = None
+
+# httpx enables HTTP/2 when the h2 package is installed
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Shared pool sizing for long-lived SDK clients (keep-alive reuse, parallel streams)
+HTTP_POOL_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
 # Cohere disabled
 # try:
 #     import cohere
@@ -295,27 +395,57 @@ from pinecone import Pinecone
 #     logger.warning("Cohere not installed - reranking will be skipped")
 
 _anthropic_client: Optional[Anthropic] = None
+_openai_client: Optional[OpenAI] = None
 _pinecone_index = None
+# Guards lazy client creation (compare mode initializes from worker threads)
+_client_lock = threading.Lock()
+
+
+def _log_pooled_client(name: str) -> None:
+    """Log the transport of a newly created SDK client (once per process, since clients are singletons)."""
+    logger.info(f"{name} client: pooled HTTP/{'2' if _HTTP2_AVAILABLE else '1.1'} (max_connections={HTTP_POOL_LIMITS.max_connections})")
 
 
 def get_anthropic_client() -> Anthropic:
     """Get or initialize Anthropic client."""
     global _anthropic_client
     if _anthropic_client is None:
-        if not config.ANTHROPIC_API_KEY:
-            raise RuntimeError("ANTHROPIC_API_KEY not configured")
-        _anthropic_client = Anthropic(api_key=config.ANTHROPIC_API_KEY)
+        with _client_lock:
+            if _anthropic_client is None:
+                if not config.ANTHROPIC_API_KEY:
+                    raise RuntimeError("ANTHROPIC_API_KEY not configured")
+                http_client = AnthropicHttpxClient(http2=_HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+                _anthropic_client = Anthropic(api_key=config.ANTHROPIC_API_KEY, http_client=http_client)
+                _log_pooled_client("Anthropic")
     return _anthropic_client
 
 
+def get_openai_client() -> OpenAI:
+    """Get or initialize OpenAI client (reused so HTTP connections stay alive)."""
+    global _openai_client
+    if _openai_client is None:
+        with _client_lock:
+            if _openai_client is None:
+                if not config.OPENAI_API_KEY:
+                    raise RuntimeError("OPENAI_API_KEY not configured")
+                http_client = OpenAIHttpxClient(http2=_HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+                _openai_client = OpenAI(api_key=config.OPENAI_API_KEY, http_client=http_client)
+                _log_pooled_client("OpenAI")
+    return _openai_client
+
+
 def get_pinecone_index():
     """Get or initialize Pinecone index."""
     global _pinecone_index
     if _pinecone_index is None:
-        if not config.PINECONE_API_KEY or not config.PINECONE_INDEX:
-            raise RuntimeError("Pinecone not configured")
-        pc = Pinecone(api_key=config.PINECONE_API_KEY)
-        _pinecone_index = pc.Index(config.PINECONE_INDEX)
+        with _client_lock:
+            if _pinecone_index is None:
+                if not config.PINECONE_API_KEY or not config.PINECONE_INDEX:
+                    raise RuntimeError("Pinecone not configured")
+                # gRPC transport (pinecone[grpc]) keeps one multiplexed channel and skips JSON encoding
+                use_grpc = config.PINECONE_USE_GRPC and PineconeGRPC is not None
+                pc = (PineconeGRPC if use_grpc else Pinecone)(api_key=config.PINECONE_API_KEY)
+                _pinecone_index = pc.Index(config.PINECONE_INDEX)
     return _pinecone_index
 
 
@@ -323,6 +453,29 @@ def get_pinecone_index():
 # SESSION STATE MANAGER (With proper logging)
 # =============================================================================
 
+# Concatenated memory file contents per directory, keyed by the directory's mtime.
+# Memory tool writes call invalidate_memory_cache() since in-place edits don't bump the dir mtime.
+_MEMORY_CONTENT_CACHE: Dict[str, Tuple[int, str]] = {}
+_memory_cache_lock = threading.Lock()
+
+
+def invalidate_memory_cache() -> None:
+    """Drop cached memory file contents (call after any memory file write)."""
+    with _memory_cache_lock:
+        _MEMORY_CONTENT_CACHE.clear()
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    """Write text via a temp file + os.replace so readers never see a partial file."""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp_path.write_text(text, encoding="utf-8")
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
 class SessionState:
     """Manages session state separately from LLM memory files."""
     
@@ -331,6 +484,13 @@ class SessionState:
         self.memory_dir = config.MEMORY_DIR / session_id if session_id != "global" else config.MEMORY_DIR
         self.memory_dir.mkdir(parents=True, exist_ok=True)
         self._cache: Optional[Dict] = None
+        self._summary: Optional[str] = None
+        self._saved_payload: Optional[str] = None  # last JSON written, to skip no-op saves
+        self._state_mtime_ns: Optional[int] = None  # state file mtime when last loaded/saved
+    
+    def invalidate(self) -> None:
+        """Drop values derived from the state (call whenever the state changes)."""
+        self._summary = None
     
     def _state_path(self) -> Path:
         return self.memory_dir / SESSION_STATE_FILE
@@ -342,6 +502,7 @@ class SessionState:
         path = self._state_path()
         if path.exists():
             try:
+                self._state_mtime_ns = path.stat().st_mtime_ns
                 self._cache = json.loads(path.read_text(encoding="utf-8"))
                 return self._cache
             except (json.JSONDecodeError, IOError) as e:
@@ -359,6 +520,19 @@ class SessionState:
         }
         return self._cache
 
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state; re-read only if the state file changed on disk since this instance loaded or saved it."""
+        if self._cache is not None:
+            try:
+                mtime_ns = self._state_path().stat().st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns is not None and mtime_ns != self._state_mtime_ns:
+                self._cache = None
+                self._saved_payload = None
+                self.invalidate()
+        return self.load()
+
     def get_note_items(self) -> Tuple[Optional[str], List[str]]:
         """Parse session_note.md and extract (topic, items)."""
         note_path = self.memory_dir / "session_note.md"
@@ -423,11 +597,14 @@ class SessionState:
     def save(self) -> None:
         if self._cache is None:
             return
+        payload = _json_dumps(self._cache)
+        if payload == self._saved_payload:
+            return
         try:
-            self._state_path().write_text(
-                json.dumps(self._cache, indent=2, ensure_ascii=False),
-                encoding="utf-8"
-            )
+            path = self._state_path()
+            _atomic_write_text(path, payload)
+            self._saved_payload = payload
+            self._state_mtime_ns = path.stat().st_mtime_ns
         except IOError as e:
             logger.error(f"Failed to save session state: {e}")
     
@@ -446,6 +623,7 @@ class SessionState:
         state.update(kwargs)
         state["turn_count"] = state.get("turn_count", 0) + 1
         self._cache = state
+        self.invalidate()
         self.save()
 
     def _list_index_path(self) -> Path:
@@ -497,6 +675,11 @@ class SessionState:
             logger.error(f"Failed to save list index: {e}")
     
     def get_summary(self) -> str:
+        if self._summary is None:
+            self._summary = self._build_summary()
+        return self._summary
+    
+    def _build_summary(self) -> str:
         state = self.load()
         parts = []
         if state.get("current_product"):
@@ -517,9 +700,45 @@ class SessionState:
     
     def clear(self) -> None:
         self._cache = {"current_product": None, "current_brand": None, "current_category": None, "last_query": None, "last_answer_preview": None, "last_list_file": None, "turn_count": 0, "conversation_history": []}
+        self.invalidate()
+        invalidate_intent_cache(self.session_id)
         self.save()
     
+    def clear_memory_files(self) -> int:
+        """Delete all non-hidden files in the memory dir; returns how many were removed."""
+        removed = 0
+        try:
+            with os.scandir(self.memory_dir) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False) and not entry.name.startswith("."):
+                        try:
+                            os.unlink(entry.path)
+                            removed += 1
+                        except OSError:
+                            pass
+        except OSError as e:
+            logger.warning(f"Failed to clear memory files: {e}")
+        self._saved_payload = None  # the state file may be gone; next save must write
+        invalidate_memory_cache()
+        return removed
+    
     def get_memory_files_content(self) -> str:
+        key = os.path.abspath(self.memory_dir)
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except OSError:
+            mtime_ns = -1
+        with _memory_cache_lock:
+            cached = _MEMORY_CONTENT_CACHE.get(key)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+        
+        content = self._read_memory_files()
+        with _memory_cache_lock:
+            _MEMORY_CONTENT_CACHE[key] = (mtime_ns, content)
+        return content
+    
+    def _read_memory_files(self) -> str:
         contents = []
         try:
             for f in sorted(self.memory_dir.iterdir()):
@@ -592,537 +811,603 @@ def get_off_topic_response(query: str) -> str:
 └─────────────────────────────────────────────────────────────────────────────
 """
 
-# Shade extraction regex patterns (applied in order, first match wins)
-# UPDATED: Added more patterns based on actual Pinecone data analysis
-SHADE_EXTRACTION_PATTERNS = [
-    # Pattern: "Product Name 70 Amazonian" → "Product Name"
-    re.compile(r'\s+\d{1,3}\s+[A-Z][a-zA-Z\s]+$'),
-    
-    # Pattern: "Product Name NU03 Maple Nude" → "Product Name"
-    re.compile(r'\s+[A-Z]{1,3}\d{1,3}\s+[A-Z][a-zA-Z\s]+$'),
-    
-    # Pattern: "Product Name #Nu02" or "Product Name #5 Red" → "Product Name"
-    re.compile(r'\s+#[A-Za-z]*\d+\s*[A-Za-z\s]*$'),
-    
-    # Pattern: "Product Name - 01 Rose" → "Product Name"
-    re.compile(r'\s+-\s*\d+\s+[A-Za-z\s]+$'),
-    
-    # Pattern: "Product Name Merry Berry - 004" → tries to extract
-    # NEW: Handles "Shade Name - Code" format at end
-    re.compile(r'\s+[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*\s+-\s*\d{2,4}$'),
-    
-    # Pattern: "Product Name (01)" → "Product Name"
-    re.compile(r'\s+\(\d+\)\s*$'),
-    
-    # Pattern: "Product Name Shade 1" → "Product Name"
-    re.compile(r'\s+Shade\s+\d+.*$', re.IGNORECASE),
-    
-    # Pattern: "Product Name No. 5" → "Product Name"
-    re.compile(r'\s+No\.?\s*\d+.*$', re.IGNORECASE),
-    
-    # Pattern: "Product Name - Nude Pink" (color name only after dash)
-    re.compile(r'\s+-\s+[A-Z][a-z]+\s+[A-Z][a-z]+$'),
-    
-    # Pattern: "Product Name Barely Brown 29" → "Product Name" (shade name + number)
-    # NEW: Handles "Shade Name Number" format
-    re.compile(r'\s+[A-Z][a-z]+\s+[A-Z][a-z]+\s+\d{1,3}$'),
-    
-    # Pattern: "Product Name 225 Delicate" → "Product Name" (number + shade name)
-    re.compile(r'\s+\d{1,3}\s+[A-Z][a-z]+$'),
-]
+# Grouping/dedup/aggregation switch, read once from config at import.
+# The full pipeline is opt-in (DISABLE_GROUPING_AND_AGGREGATION=false). When disabled,
+# none of the grouping helpers, caches or shade regexes exist in the module and
+# general_product_qna passes _slim_hits() output to Layer 2 instead.
+DISABLE_GROUPING_AND_AGGREGATION = config.DISABLE_GROUPING_AND_AGGREGATION
 
-# Patterns that should NOT be stripped (part of product name, not shade)
-KEEP_PATTERNS = ["9to5", "24H", "16H", "2in1", "3in1"]
+if not DISABLE_GROUPING_AND_AGGREGATION:
+    # Shade extraction regex patterns (applied in order, first match wins)
+    # UPDATED: Added more patterns based on actual Pinecone data analysis
+    _SHADE_PATTERN_SPECS: List[str] = [
+        # Pattern: "Product Name 70 Amazonian" → "Product Name"
+        r'\s+\d{1,3}\s+[A-Z][a-zA-Z\s]+$',
 
+        # Pattern: "Product Name NU03 Maple Nude" → "Product Name"
+        r'\s+[A-Z]{1,3}\d{1,3}\s+[A-Z][a-zA-Z\s]+$',
 
-def get_product_grouping_key(metadata: Dict) -> str:
-    """
-    Get unique key for grouping shades of same product.
-    Uses 3-tier approach: metadata → clean product_name → regex → brand+category
-    
-    UPDATED: Better handling of actual Pinecone data structure
-    """
-    brand = metadata.get("brand", "").strip()
-    
-    # TIER 1: Direct metadata fields (most reliable)
-    # product_line is the best source when available
-    if metadata.get("product_line"):
-        return f"{brand}|{metadata['product_line']}"
-    if metadata.get("sku_family"):
-        return f"{brand}|{metadata['sku_family']}"
-    if metadata.get("product_family"):
-        return f"{brand}|{metadata['product_family']}"
-    
-    # TIER 2: Check if product_name is already clean (shade in separate field)
-    # attrs::N chunks typically have clean product_name
-    product_name = metadata.get("product_name") or metadata.get("title") or ""
-    shade = metadata.get("shade", "")
-    
-    # If shade exists AND product_name doesn't contain the shade, product_name is clean
-    if shade and shade not in product_name:
-        return f"{brand}|{product_name}"
-    
-    # TIER 3: Try regex extraction if product_name contains shade
-    base_name = extract_product_base_name(product_name)
-    if base_name and base_name != product_name:
-        return f"{brand}|{base_name}"
-    
-    # TIER 4: Brand + Category fallback
-    category = metadata.get("leaf_level_category") or metadata.get("sub_category") or metadata.get("category") or ""
-    if brand and category:
-        return f"{brand}|{category}|{product_name}"
-    
-    return f"{brand}|{product_name}"
+        # Pattern: "Product Name #Nu02" or "Product Name #5 Red" → "Product Name"
+        r'\s+#[A-Za-z]*\d+\s*[A-Za-z\s]*$',
 
+        # Pattern: "Product Name - 01 Rose" → "Product Name"
+        r'\s+-\s*\d+\s+[A-Za-z\s]+$',
 
-def get_clean_product_name(metadata: Dict) -> str:
-    """
-    Get clean product name for display (without shade).
-    
-    PRIORITY:
-    1. brand + product_line (most reliable)
-    2. brand + product_name (if product_name is clean)
-    3. Regex extraction (fallback)
-    """
-    brand = metadata.get("brand", "").strip()
-    product_line = metadata.get("product_line", "").strip()
-    product_name = metadata.get("product_name") or metadata.get("title") or ""
-    shade = metadata.get("shade", "")
-    
-    # BEST: Use product_line if available
-    if product_line:
-        if brand and brand.lower() not in product_line.lower():
-            return f"{brand} {product_line}"
-        return product_line
-    
-    # GOOD: If product_name is clean (shade is separate field)
-    if shade and shade not in product_name:
-        if brand and brand.lower() not in product_name.lower():
-            return f"{brand} {product_name}"
-        return product_name
-    
-    # FALLBACK: Try regex extraction
-    base_name = extract_product_base_name(product_name)
-    if brand and brand.lower() not in base_name.lower():
-        return f"{brand} {base_name}"
-    return base_name
-
-
-def get_section_key(metadata: Dict) -> str:
-    """
-    Extract section identifier from chunk for diversity tracking.
-    
-    Returns section_key like 'attrs::5', 'attrs::11', 'product', 'sec-4'
-    """
-    # Try section_key field first
-    if metadata.get("section_key"):
-        return metadata["section_key"]
-    
-    # Try to extract from parent_id (e.g., "SKU::attrs::5" or "SKU::product")
-    parent_id = metadata.get("parent_id", "")
-    if "::" in parent_id:
-        parts = parent_id.split("::")
-        if len(parts) >= 2:
-            # Return everything after the SKU
-            return "::".join(parts[1:])
-    
-    # Fallback to section_index
-    section_idx = metadata.get("section_index")
-    if section_idx is not None:
-        return f"section_{int(section_idx)}"
-    
-    return "unknown"
+        # Pattern: "Product Name Merry Berry - 004" → tries to extract
+        # NEW: Handles "Shade Name - Code" format at end
+        r'\s+[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*\s+-\s*\d{2,4}$',
 
+        # Pattern: "Product Name (01)" → "Product Name"
+        r'\s+\(\d+\)\s*$',
 
-def extract_product_base_name(full_name: str) -> str:
-    """
-    Extract base product name without shade/color variants using regex.
-    
-    FALLBACK method - only used when metadata fields don't provide clean name.
-    
-    Examples:
-        "Maybelline SuperStay Matte Ink 70 Amazonian" → "Maybelline SuperStay Matte Ink"
-        "Focallure Airy Velvet Lipcream #Nu02" → "Focallure Airy Velvet Lipcream"
-        "Daily Life FOREVER52 Sensational Lip Merry Berry - 004" → tries to extract
-    """
-    if not full_name:
-        return "Unknown Product"
-    
-    result = full_name.strip()
-    
-    # Check for patterns we should keep (avoid false positives)
-    has_keep_pattern = any(keep.lower() in result.lower() for keep in KEEP_PATTERNS)
-    
-    if not has_keep_pattern:
-        # Apply shade extraction patterns
-        for pattern in SHADE_EXTRACTION_PATTERNS:
-            new_result = pattern.sub('', result)
-            if new_result != result and len(new_result) > 5:
-                result = new_result.strip()
-                break
-    
-    # Clean trailing punctuation
-    result = re.sub(r'[\s\-]+$', '', result)
-    
-    return result if result else full_name
+        # Pattern: "Product Name Shade 1" → "Product Name"
+        r'(?i:\s+Shade\s+\d+.*)$',
 
+        # Pattern: "Product Name No. 5" → "Product Name"
+        r'(?i:\s+No\.?\s*\d+.*)$',
 
-def dedupe_by_product(retrieved: List[Dict], max_chunks_per_product: int = MAX_CHUNKS_PER_PRODUCT) -> List[Dict]:
-    """
-    Deduplicate retrieved chunks by product, keeping top N per unique product.
-    
-    UPDATED: Now prioritizes SECTION DIVERSITY to get different types of data
-    (e.g., attrs::5 for ingredients, attrs::11 for issues, attrs::2 for performance)
-    
-    Strategy:
-    1. Group all chunks by product
-    2. For each product, try to get diverse section types first
-    3. Fill remaining slots with highest-scored chunks
-    """
-    if not retrieved:
-        return []
-    
-    # First pass: group by product
-    product_chunks: Dict[str, List[Dict]] = {}
-    
-    for item in retrieved:
-        metadata = item.get("metadata", {})
-        grouping_key = get_product_grouping_key(metadata)
-        base_name = get_clean_product_name(metadata)
-        section_key = get_section_key(metadata)
-        
-        # Add computed fields to metadata
-        item["metadata"]["product_grouping_key"] = grouping_key
-        item["metadata"]["product_base_name"] = base_name
-        item["metadata"]["_section_key"] = section_key
-        
-        if grouping_key not in product_chunks:
-            product_chunks[grouping_key] = []
-        product_chunks[grouping_key].append(item)
-    
-    # Second pass: select diverse chunks for each product
-    result: List[Dict] = []
-    
-    for grouping_key, chunks in product_chunks.items():
-        selected = _select_diverse_chunks(chunks, max_chunks_per_product)
-        result.extend(selected)
-    
-    # Sort by original score to maintain relevance order
-    result = sorted(result, key=lambda x: x.get("score", 0), reverse=True)
-    
-    logger.info(f"Dedupe: {len(retrieved)} → {len(result)} ({len(product_chunks)} unique products)")
-    return result
+        # Pattern: "Product Name - Nude Pink" (color name only after dash)
+        r'\s+-\s+[A-Z][a-z]+\s+[A-Z][a-z]+$',
 
+        # Pattern: "Product Name Barely Brown 29" → "Product Name" (shade name + number)
+        # NEW: Handles "Shade Name Number" format
+        r'\s+[A-Z][a-z]+\s+[A-Z][a-z]+\s+\d{1,3}$',
 
-def _select_diverse_chunks(chunks: List[Dict], max_chunks: int) -> List[Dict]:
-    """
-    Select chunks prioritizing section diversity.
-    
-    Priority sections (in order of importance for recommendations):
-    1. 'product' or 'sec-' - Product overview
-    2. 'attrs::2' or 'section_04' - Performance metrics
-    3. 'attrs::11' or 'section_13' - Issue flags
-    4. 'attrs::5' or 'section_07' - Formula/ingredients
-    5. 'attrs::1' or 'section_03' - Finish description
-    """
-    if len(chunks) <= max_chunks:
-        return chunks
-    
-    # Sort by score first
-    sorted_chunks = sorted(chunks, key=lambda x: x.get("score", 0), reverse=True)
-    
-    # Priority section patterns
-    priority_patterns = [
-        ["product", "sec-"],           # Product overview
-        ["attrs::2", "section_04"],     # Performance
-        ["attrs::11", "section_13"],    # Issue flags
-        ["attrs::5", "section_07"],     # Formula/ingredients
-        ["attrs::1", "section_03"],     # Finish
+        # Pattern: "Product Name 225 Delicate" → "Product Name" (number + shade name)
+        r'\s+\d{1,3}\s+[A-Z][a-z]+$',
     ]
-    
-    selected: List[Dict] = []
-    used_indices: Set[int] = set()
-    
-    # First: try to get one chunk from each priority section
-    for patterns in priority_patterns:
-        if len(selected) >= max_chunks:
-            break
-        for idx, chunk in enumerate(sorted_chunks):
-            if idx in used_indices:
-                continue
-            section = chunk.get("metadata", {}).get("_section_key", "")
-            if any(p in section for p in patterns):
-                selected.append(chunk)
-                used_indices.add(idx)
-                break
-    
-    # Second: fill remaining slots with highest-scored chunks we haven't used
-    for idx, chunk in enumerate(sorted_chunks):
-        if len(selected) >= max_chunks:
-            break
-        if idx not in used_indices:
-            selected.append(chunk)
-            used_indices.add(idx)
-    
-    return selected
 
+    # Optional RE2 engine (pip install google-re2): linear-time matching, no backtracking.
+    # Specs use inline (?i:...) flags so they compile unchanged under either engine.
+    try:
+        import re2 as _shade_regex_engine
+    except ImportError:
+        _shade_regex_engine = re
 
-# =============================================================================
-# PRODUCT AGGREGATION (SIMPLIFIED - v3.2)
-# =============================================================================
-"""
-┌─────────────────────────────────────────────────────────────────────────────
-│ PRODUCT AGGREGATION - NO HARDCODED FIELD LISTS
-├─────────────────────────────────────────────────────────────────────────────
-│
-│ KEY INSIGHT: Your metrics are in the `content` text field, not as separate
-│ metadata keys. So we pass ALL metadata/content to Layer 2 for the LLM to parse.
-│
-│ APPROACH:
-│   1. Use `shade` field directly from metadata (not extracted from product_name)
-│   2. Pass ALL metadata to Layer 2 without filtering
-│   3. Let LLM parse the `content` text for metrics
-│   4. Collect ANY numeric/boolean/text fields dynamically (no hardcoded lists)
-│
-└─────────────────────────────────────────────────────────────────────────────
-"""
+    SHADE_EXTRACTION_PATTERNS = [_shade_regex_engine.compile(p) for p in _SHADE_PATTERN_SPECS]
 
-# Fields to EXCLUDE from dynamic aggregation (internal/structural fields)
-EXCLUDE_FROM_AGGREGATION = {
-    "content", "content_len", "chunk_index", "total_chunks", "parent_id",
-    "section_index", "section_key", "section_title", "language",
-    "product_grouping_key", "product_base_name", "_section_key",
-    "sku", "product_id", "unique_code",
-}
+    # All patterns in one alternation: a single scan rejects names with no shade suffix
+    _SHADE_ANY_PATTERN = _shade_regex_engine.compile("(?:" + "|".join(_SHADE_PATTERN_SPECS) + ")")
 
+    # Patterns that should NOT be stripped (part of product name, not shade)
+    KEEP_PATTERNS = ["9to5", "24H", "16H", "2in1", "3in1"]
 
-def aggregate_products_for_display(retrieved: List[Dict]) -> List[Dict]:
-    """
-    Aggregate multiple shade entries into single product entries.
-    
-    SIMPLIFIED v3.2:
-    - Uses `shade` field directly from metadata
-    - Dynamically collects ALL metadata fields (no hardcoded lists)
-    - Passes full content to Layer 2 for LLM parsing
-    """
-    if not retrieved:
-        return []
-    
-    products: Dict[str, Dict] = {}
-    
-    for item in retrieved:
-        metadata = item.get("metadata", {})
-        grouping_key = metadata.get("product_grouping_key") or get_product_grouping_key(metadata)
-        base_name = metadata.get("product_base_name") or get_clean_product_name(metadata)
-        
-        if grouping_key not in products:
-            products[grouping_key] = {
-                "product_base_name": base_name,
-                "brand": metadata.get("brand"),
-                "category": metadata.get("leaf_level_category") or metadata.get("sub_category") or metadata.get("category"),
-                "product_line": metadata.get("product_line"),
-                "product_type": metadata.get("product_type"),
-                "shades_seen": [],
-                "skus_seen": [],
-                "sections_seen": [],
-                "best_score": item.get("score", 0),
-                "best_item": item,
-                "all_chunks": [],  # Keep full chunks for Layer 2
-                "_dynamic_values": {},  # Dynamically collected metrics
-            }
-        
-        product = products[grouping_key]
-        
-        # Track shade using the `shade` field directly (not extracted from product_name)
+    # Composed grouping keys, reused across all shade chunks of the same product
+    # RATIONALE: brand/product_line repeat for every shade, so interning the parts and
+    #            caching the joined key avoids a fresh string + hash per chunk
+    _GROUPING_KEY_CACHE: Dict[Tuple[str, ...], str] = {}
+    _GROUPING_KEY_CACHE_MAX = 4096
+
+
+    @functools.lru_cache(maxsize=2048)
+    def _strip(value: str) -> str:
+        """Memoized str.strip() for small-cardinality metadata values (brand, product_line)."""
+        return value.strip()
+
+
+    @functools.lru_cache(maxsize=2048)
+    def _strip_lower(value: str) -> str:
+        """Memoized strip().lower() for values that repeat across every chunk."""
+        return value.strip().lower()
+
+
+    def _intern(value: Any) -> str:
+        """Intern a metadata value (small cardinality, high reuse)."""
+        return sys.intern(value if isinstance(value, str) else str(value))
+
+
+    def _grouping_key(*parts: str) -> str:
+        """Return the interned "a|b|..." key for parts, reusing previously built keys."""
+        key = _GROUPING_KEY_CACHE.get(parts)
+        if key is None:
+            if len(_GROUPING_KEY_CACHE) >= _GROUPING_KEY_CACHE_MAX:
+                _GROUPING_KEY_CACHE.clear()
+            key = _GROUPING_KEY_CACHE.setdefault(parts, sys.intern("|".join(parts)))
+        return key
+
+
+    def get_product_grouping_key(metadata: Dict) -> str:
+        """
+        Get unique key for grouping shades of same product.
+        Uses 3-tier approach: metadata → clean product_name → regex → brand+category
+
+        UPDATED: Better handling of actual Pinecone data structure
+        """
+        brand = _intern(_strip(metadata.get("brand") or ""))
+
+        # TIER 1: Direct metadata fields (most reliable)
+        # product_line is the best source when available
+        if metadata.get("product_line"):
+            return _grouping_key(brand, _intern(metadata["product_line"]))
+        if metadata.get("sku_family"):
+            return _grouping_key(brand, _intern(metadata["sku_family"]))
+        if metadata.get("product_family"):
+            return _grouping_key(brand, _intern(metadata["product_family"]))
+
+        # TIER 2: Check if product_name is already clean (shade in separate field)
+        # attrs::N chunks typically have clean product_name
+        product_name = metadata.get("product_name") or metadata.get("title") or ""
         shade = metadata.get("shade", "")
-        if shade and shade not in product["shades_seen"]:
-            product["shades_seen"].append(shade)
-        
-        # Track SKUs for reference
-        sku = metadata.get("sku", "")
-        if sku and sku not in product["skus_seen"]:
-            product["skus_seen"].append(sku)
-        
-        # Track sections for diversity info
-        section_key = metadata.get("_section_key") or metadata.get("section_key") or ""
-        section_title = metadata.get("section_title", "")
-        if section_title and section_title not in product["sections_seen"]:
-            product["sections_seen"].append(section_title)
-        
-        # Track best score
-        score = item.get("score", 0)
-        if score > product["best_score"]:
-            product["best_score"] = score
-            product["best_item"] = item
-        
-        # Store full chunk (with content) for Layer 2
-        product["all_chunks"].append({
-            "score": score,
-            "section": section_title,
-            "content": metadata.get("content", ""),
-            "shade": shade,
-        })
-        
-        # Dynamically collect ALL metadata fields
-        _collect_dynamic_metrics(product, metadata)
-    
-    # Build final list
-    result = [_build_aggregated_product(p) for p in products.values()]
-    result = sorted(result, key=lambda x: x["relevance_score"], reverse=True)
-    
-    logger.info(f"Aggregated: {len(result)} unique products from {len(retrieved)} entries")
-    return result
 
+        # If shade exists AND product_name doesn't contain the shade, product_name is clean
+        if shade and shade not in product_name:
+            return _grouping_key(brand, product_name)
 
-def _collect_dynamic_metrics(product: Dict, metadata: Dict) -> None:
-    """
-    Dynamically collect ALL metadata fields without hardcoded lists.
-    Automatically detects numeric, boolean, and text values.
-    """
-    for field, value in metadata.items():
-        # Skip excluded fields
-        if field in EXCLUDE_FROM_AGGREGATION:
-            continue
-        
-        # Skip None values
-        if value is None:
-            continue
-        
-        # Initialize field storage if needed
-        if field not in product["_dynamic_values"]:
-            product["_dynamic_values"][field] = {"values": [], "type": None}
-        
-        field_data = product["_dynamic_values"][field]
-        
-        # Detect and store value based on type
-        if isinstance(value, bool):
-            field_data["type"] = "boolean"
-            field_data["values"].append(value)
-        elif isinstance(value, (int, float)):
-            field_data["type"] = "numeric"
-            field_data["values"].append(float(value))
-        elif isinstance(value, str):
-            # Try to detect if string is actually numeric or boolean
-            stripped = value.strip().lower()
-            if stripped in ("true", "yes", "1"):
-                field_data["type"] = "boolean"
-                field_data["values"].append(True)
-            elif stripped in ("false", "no", "0"):
-                field_data["type"] = "boolean"
-                field_data["values"].append(False)
-            else:
-                # Try numeric conversion
-                try:
-                    num_val = float(value)
-                    field_data["type"] = "numeric"
-                    field_data["values"].append(num_val)
-                except (ValueError, TypeError):
-                    # Keep as text
-                    field_data["type"] = "text"
-                    if value not in field_data["values"]:
-                        field_data["values"].append(value)
+        # TIER 3: Try regex extraction if product_name contains shade
+        base_name = extract_product_base_name(product_name)
+        if base_name and base_name != product_name:
+            return _grouping_key(brand, base_name)
 
+        # TIER 4: Brand + Category fallback
+        category = metadata.get("leaf_level_category") or metadata.get("sub_category") or metadata.get("category") or ""
+        if brand and category:
+            return _grouping_key(brand, _intern(category), product_name)
 
-def _build_aggregated_product(product: Dict) -> Dict:
-    """Build final aggregated product with computed metrics."""
-    
-    # Compute aggregated values from dynamic collection
-    aggregated_metrics = {}
-    
-    for field, data in product.get("_dynamic_values", {}).items():
-        values = data.get("values", [])
-        value_type = data.get("type")
-        
-        if not values:
-            continue
-        
-        if value_type == "numeric":
-            # Average numeric values
-            avg = sum(values) / len(values)
-            # Round based on field name hints
-            if any(kw in field.lower() for kw in ["hour", "time", "duration", "wear"]):
-                aggregated_metrics[field] = round(avg, 1)
-            elif any(kw in field.lower() for kw in ["score", "rating", "level"]):
-                aggregated_metrics[field] = round(avg, 1)
-            elif any(kw in field.lower() for kw in ["price", "mrp", "cost"]):
-                aggregated_metrics[field] = round(avg, 0)
-            else:
-                aggregated_metrics[field] = round(avg, 2) if avg != int(avg) else int(avg)
-                
-        elif value_type == "boolean":
-            # Majority vote
-            true_count = sum(1 for v in values if v)
-            aggregated_metrics[field] = true_count > len(values) / 2
-            
-        elif value_type == "text":
-            # Combine unique text values
-            unique_values = list(dict.fromkeys(values))  # Preserve order, remove dupes
-            if len(unique_values) == 1:
-                aggregated_metrics[field] = unique_values[0]
+        return _grouping_key(brand, product_name)
+
+
+    def get_clean_product_name(metadata: Dict) -> str:
+        """
+        Get clean product name for display (without shade).
+
+        PRIORITY:
+        1. brand + product_line (most reliable)
+        2. brand + product_name (if product_name is clean)
+        3. Regex extraction (fallback)
+        """
+        brand = _strip(metadata.get("brand") or "")
+        product_line = _strip(metadata.get("product_line") or "")
+        product_name = metadata.get("product_name") or metadata.get("title") or ""
+        shade = metadata.get("shade", "")
+        brand_lower = _strip_lower(brand)
+
+        # BEST: Use product_line if available
+        if product_line:
+            if brand and brand_lower not in _strip_lower(product_line):
+                return f"{brand} {product_line}"
+            return product_line
+
+        # GOOD: If product_name is clean (shade is separate field)
+        if shade and shade not in product_name:
+            if brand and brand_lower not in _strip_lower(product_name):
+                return f"{brand} {product_name}"
+            return product_name
+
+        # FALLBACK: Try regex extraction
+        base_name = extract_product_base_name(product_name)
+        if brand and brand_lower not in _strip_lower(base_name):
+            return f"{brand} {base_name}"
+        return base_name
+
+
+    def get_section_key(metadata: Dict) -> str:
+        """
+        Extract section identifier from chunk for diversity tracking.
+
+        Returns section_key like 'attrs::5', 'attrs::11', 'product', 'sec-4'
+        """
+        # Try section_key field first
+        if metadata.get("section_key"):
+            return metadata["section_key"]
+
+        # Try to extract from parent_id (e.g., "SKU::attrs::5" or "SKU::product")
+        parent_id = metadata.get("parent_id", "")
+        if "::" in parent_id:
+            parts = parent_id.split("::")
+            if len(parts) >= 2:
+                # Return everything after the SKU
+                return "::".join(parts[1:])
+
+        # Fallback to section_index
+        section_idx = metadata.get("section_index")
+        if section_idx is not None:
+            return f"section_{int(section_idx)}"
+
+        return "unknown"
+
+
+    def extract_product_base_name(full_name: str) -> str:
+        """
+        Extract base product name without shade/color variants using regex.
+
+        FALLBACK method - only used when metadata fields don't provide clean name.
+
+        Examples:
+            "Maybelline SuperStay Matte Ink 70 Amazonian" → "Maybelline SuperStay Matte Ink"
+            "Focallure Airy Velvet Lipcream #Nu02" → "Focallure Airy Velvet Lipcream"
+            "Daily Life FOREVER52 Sensational Lip Merry Berry - 004" → tries to extract
+        """
+        if not full_name:
+            return "Unknown Product"
+
+        result = full_name.strip()
+
+        # Check for patterns we should keep (avoid false positives)
+        has_keep_pattern = any(keep.lower() in result.lower() for keep in KEEP_PATTERNS)
+
+        if not has_keep_pattern and _SHADE_ANY_PATTERN.search(result):
+            # Apply shade extraction patterns
+            for pattern in SHADE_EXTRACTION_PATTERNS:
+                new_result = pattern.sub('', result)
+                if new_result != result and len(new_result) > 5:
+                    result = new_result.strip()
+                    break
+
+        # Clean trailing punctuation
+        result = re.sub(r'[\s\-]+$', '', result)
+
+        return result if result else full_name
+
+
+    # Priority section patterns (in order of importance for recommendations)
+    _PRIORITY_SECTION_PATTERNS: Tuple[Tuple[str, ...], ...] = (
+        ("product", "sec-"),           # Product overview
+        ("attrs::2", "section_04"),     # Performance
+        ("attrs::11", "section_13"),    # Issue flags
+        ("attrs::5", "section_07"),     # Formula/ingredients
+        ("attrs::1", "section_03"),     # Finish
+    )
+
+
+    def _push_bounded(heap: List[Tuple], entry: Tuple, cap: int) -> None:
+        """Keep only the `cap` best entries in a min-heap (root = weakest kept entry)."""
+        if len(heap) < cap:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+
+    def dedupe_by_product(retrieved: List[Dict], max_chunks_per_product: int = MAX_CHUNKS_PER_PRODUCT) -> List[Dict]:
+        """
+        Deduplicate retrieved chunks by product, keeping top N per unique product.
+
+        UPDATED: Now prioritizes SECTION DIVERSITY to get different types of data
+        (e.g., attrs::5 for ingredients, attrs::11 for issues, attrs::2 for performance)
+
+        Strategy:
+        1. Stream chunks once, keeping bounded candidate heaps per product
+        2. For each product, try to get diverse section types first
+        3. Fill remaining slots with highest-scored chunks
+
+        A chunk can only be selected if it is among the top N of its product overall or
+        among the top N matching one priority section, so nothing else is retained.
+        """
+        if not retrieved:
+            return []
+
+        # Single pass: group by product into bounded heaps of (score, -position, item)
+        # product key → [chunk count, top-N overall heap, top-N heap per priority section]
+        candidates: Dict[str, List[Any]] = {}
+
+        for position, item in enumerate(retrieved):
+            metadata = item.get("metadata", {})
+            grouping_key = get_product_grouping_key(metadata)
+            base_name = get_clean_product_name(metadata)
+            section_key = get_section_key(metadata)
+
+            # Add computed fields to metadata
+            item["metadata"]["product_grouping_key"] = grouping_key
+            item["metadata"]["product_base_name"] = base_name
+            item["metadata"]["_section_key"] = section_key
+
+            state = candidates.get(grouping_key)
+            if state is None:
+                state = candidates[grouping_key] = [0, [], [[] for _ in _PRIORITY_SECTION_PATTERNS]]
+            state[0] += 1
+
+            entry = (item.get("score", 0) or 0, -position, item)
+            _push_bounded(state[1], entry, max_chunks_per_product)
+            for patterns, section_heap in zip(_PRIORITY_SECTION_PATTERNS, state[2]):
+                if any(p in section_key for p in patterns):
+                    _push_bounded(section_heap, entry, max_chunks_per_product)
+
+        # Select diverse chunks for each product from its bounded candidates
+        result: List[Dict] = []
+
+        for count, top_heap, section_heaps in candidates.values():
+            by_position = {-entry[1]: entry for heap in (top_heap, *section_heaps) for entry in heap}
+            if count <= max_chunks_per_product:
+                # Every chunk survives; keep original retrieval order
+                result.extend(by_position[pos][2] for pos in sorted(by_position))
             else:
-                aggregated_metrics[field] = unique_values  # Keep as list for multiple values
-    
-    # Get representative metadata from best item
-    best_metadata = product["best_item"].get("metadata", {}) if product.get("best_item") else {}
-    
-    return {
-        "product": product["product_base_name"],
-        "brand": product["brand"],
-        "category": product["category"],
-        "product_line": product.get("product_line"),
-        "product_type": product.get("product_type"),
-        "shades_available": product["shades_seen"],
-        "shades_count": len(product["shades_seen"]),
-        "skus": product["skus_seen"],
-        "sections_covered": product["sections_seen"],
-        "relevance_score": round(product["best_score"], 4),
-        "aggregated_metrics": aggregated_metrics,
-        "detailed_data": {
-            "full_name": best_metadata.get("full_name") or best_metadata.get("product_name"),
-            "sku": best_metadata.get("sku"),
-            "content_preview": (best_metadata.get("content") or "")[:500],  # Preview for context
-        },
-        "all_chunks": product["all_chunks"],  # Full content for Layer 2
+                ranked = sorted(by_position.values(), reverse=True)
+                result.extend(_pick_diverse_chunks([entry[2] for entry in ranked], max_chunks_per_product))
+
+        # Sort by original score to maintain relevance order
+        result.sort(key=lambda x: x.get("score", 0), reverse=True)
+
+        logger.info(f"Dedupe: {len(retrieved)} → {len(result)} ({len(candidates)} unique products)")
+        return result
+
+
+    def _pick_diverse_chunks(sorted_chunks: List[Dict], max_chunks: int) -> List[Dict]:
+        """
+        Select chunks (already sorted by score) prioritizing section diversity.
+
+        Priority sections (in order of importance for recommendations):
+        1. 'product' or 'sec-' - Product overview
+        2. 'attrs::2' or 'section_04' - Performance metrics
+        3. 'attrs::11' or 'section_13' - Issue flags
+        4. 'attrs::5' or 'section_07' - Formula/ingredients
+        5. 'attrs::1' or 'section_03' - Finish description
+        """
+        selected: List[Dict] = []
+        used_indices: Set[int] = set()
+
+        # First: try to get one chunk from each priority section
+        for patterns in _PRIORITY_SECTION_PATTERNS:
+            if len(selected) >= max_chunks:
+                break
+            for idx, chunk in enumerate(sorted_chunks):
+                if idx in used_indices:
+                    continue
+                section = chunk.get("metadata", {}).get("_section_key", "")
+                if any(p in section for p in patterns):
+                    selected.append(chunk)
+                    used_indices.add(idx)
+                    break
+
+        # Second: fill remaining slots with highest-scored chunks we haven't used
+        for idx, chunk in enumerate(sorted_chunks):
+            if len(selected) >= max_chunks:
+                break
+            if idx not in used_indices:
+                selected.append(chunk)
+                used_indices.add(idx)
+
+        return selected
+
+
+    # =============================================================================
+    # PRODUCT AGGREGATION (SIMPLIFIED - v3.2)
+    # =============================================================================
+    """
+    ┌─────────────────────────────────────────────────────────────────────────────
+    │ PRODUCT AGGREGATION - NO HARDCODED FIELD LISTS
+    ├─────────────────────────────────────────────────────────────────────────────
+    │
+    │ KEY INSIGHT: Your metrics are in the `content` text field, not as separate
+    │ metadata keys. So we pass ALL metadata/content to Layer 2 for the LLM to parse.
+    │
+    │ APPROACH:
+    │   1. Use `shade` field directly from metadata (not extracted from product_name)
+    │   2. Pass ALL metadata to Layer 2 without filtering
+    │   3. Let LLM parse the `content` text for metrics
+    │   4. Collect ANY numeric/boolean/text fields dynamically (no hardcoded lists)
+    │
+    └─────────────────────────────────────────────────────────────────────────────
+    """
+
+    # Fields to EXCLUDE from dynamic aggregation (internal/structural fields)
+    EXCLUDE_FROM_AGGREGATION = {
+        "content", "content_len", "chunk_index", "total_chunks", "parent_id",
+        "section_index", "section_key", "section_title", "language",
+        "product_grouping_key", "product_base_name", "_section_key",
+        "sku", "product_id", "unique_code",
     }
 
 
-def get_unique_product_names(aggregated_products: List[Dict]) -> List[str]:
-    """Extract list of unique product names for web search validation."""
-    return [p.get("product", "") for p in aggregated_products 
-            if p.get("product") and p.get("product") != "Unknown Product"]
+    class _ProductAgg:
+        """Per-product accumulator used while aggregating shade chunks (slotted, no per-instance dict)."""
 
+        __slots__ = (
+            "product_base_name", "brand", "category", "product_line", "product_type",
+            "shades_seen", "skus_seen", "sections_seen", "best_score", "best_item",
+            "chunk_scores", "chunk_sections", "chunk_contents", "chunk_shades", "dynamic_values",
+        )
 
-# =============================================================================
-# DISABLE GROUPING/DEDUP/AGGREGATION (OVERRIDES)
-# =============================================================================
-# Per request: bypass shade/product grouping, deduplication, and dynamic aggregation.
-# Keep the original implementations above intact but override their usage here to
-# avoid complex processing. This ensures the pipeline continues to run.
-DISABLE_GROUPING_AND_AGGREGATION = True
+        def __init__(self, product_base_name: str, brand: Optional[str], category: Optional[str],
+                     product_line: Optional[str], product_type: Optional[str],
+                     best_score: float, best_item: Dict):
+            self.product_base_name = product_base_name
+            self.brand = brand
+            self.category = category
+            self.product_line = product_line
+            self.product_type = product_type
+            self.shades_seen: List[str] = []
+            self.skus_seen: List[str] = []
+            self.sections_seen: List[str] = []
+            self.best_score = best_score
+            self.best_item = best_item
+            # Full chunks for Layer 2, stored as parallel lists (one entry per chunk)
+            self.chunk_scores: List[float] = []
+            self.chunk_sections: List[str] = []
+            self.chunk_contents: List[str] = []
+            self.chunk_shades: List[str] = []
+            self.dynamic_values: Dict[str, Dict] = {}  # Dynamically collected metrics
 
-if DISABLE_GROUPING_AND_AGGREGATION:
-    def dedupe_by_product(retrieved: List[Dict], max_chunks_per_product: int = MAX_CHUNKS_PER_PRODUCT) -> List[Dict]:
-        """Bypass deduplication and return the retrieved list as-is."""
-        return retrieved or []
 
     def aggregate_products_for_display(retrieved: List[Dict]) -> List[Dict]:
-        """Minimal passthrough aggregation to keep Layer 2 input shape stable."""
+        """
+        Aggregate multiple shade entries into single product entries.
+
+        SIMPLIFIED v3.2:
+        - Uses `shade` field directly from metadata
+        - Dynamically collects ALL metadata fields (no hardcoded lists)
+        - Passes full content to Layer 2 for LLM parsing
+        """
         if not retrieved:
             return []
-        products: List[Dict] = []
+
+        products: Dict[str, _ProductAgg] = {}
+
         for item in retrieved:
-            md = item.get("metadata", {}) or {}
-            products.append({
-                "product_base_name": md.get("product_name") or md.get("full_name") or md.get("title") or "Unknown Product",
-                "brand": md.get("brand"),
-                "category": md.get("leaf_level_category") or md.get("sub_category") or md.get("category"),
-                "shades_seen": [md.get("shade")] if md.get("shade") else [],
-                "shades_count": 1 if md.get("shade") else 0,
-                "best_score": item.get("score", 0) or 0.0,
-                "aggregated_metrics": {},
-                "representative_metadata": md,
-            })
-        return products
+            metadata = item.get("metadata", {})
+            grouping_key = metadata.get("product_grouping_key") or get_product_grouping_key(metadata)
+            base_name = metadata.get("product_base_name") or get_clean_product_name(metadata)
+
+            product = products.get(grouping_key)
+            if product is None:
+                product = products[grouping_key] = _ProductAgg(
+                    product_base_name=base_name,
+                    brand=metadata.get("brand"),
+                    category=metadata.get("leaf_level_category") or metadata.get("sub_category") or metadata.get("category"),
+                    product_line=metadata.get("product_line"),
+                    product_type=metadata.get("product_type"),
+                    best_score=item.get("score", 0),
+                    best_item=item,
+                )
+
+            # Track shade using the `shade` field directly (not extracted from product_name)
+            shade = metadata.get("shade", "")
+            if shade and shade not in product.shades_seen:
+                product.shades_seen.append(shade)
+
+            # Track SKUs for reference
+            sku = metadata.get("sku", "")
+            if sku and sku not in product.skus_seen:
+                product.skus_seen.append(sku)
+
+            # Track sections for diversity info
+            section_key = metadata.get("_section_key") or metadata.get("section_key") or ""
+            section_title = metadata.get("section_title", "")
+            if section_title and section_title not in product.sections_seen:
+                product.sections_seen.append(section_title)
+
+            # Track best score
+            score = item.get("score", 0)
+            if score > product.best_score:
+                product.best_score = score
+                product.best_item = item
+
+            # Store full chunk (with content) for Layer 2
+            product.chunk_scores.append(score)
+            product.chunk_sections.append(section_title)
+            product.chunk_contents.append(metadata.get("content", ""))
+            product.chunk_shades.append(shade)
+
+            # Dynamically collect ALL metadata fields
+            _collect_dynamic_metrics(product, metadata)
+
+        # Build final list
+        result = [_build_aggregated_product(p) for p in products.values()]
+        result = sorted(result, key=lambda x: x["relevance_score"], reverse=True)
+
+        logger.info(f"Aggregated: {len(result)} unique products from {len(retrieved)} entries")
+        return result
+
+
+    def _collect_dynamic_metrics(product: _ProductAgg, metadata: Dict) -> None:
+        """
+        Dynamically collect ALL metadata fields without hardcoded lists.
+        Automatically detects numeric, boolean, and text values.
+        """
+        for field, value in metadata.items():
+            # Skip excluded fields
+            if field in EXCLUDE_FROM_AGGREGATION:
+                continue
+
+            # Skip None values
+            if value is None:
+                continue
+
+            # Initialize field storage if needed
+            field_data = product.dynamic_values.get(field)
+            if field_data is None:
+                field_data = product.dynamic_values[field] = {"values": [], "type": None, "seen": set()}
+
+            # Detect and store value based on type
+            if isinstance(value, bool):
+                field_data["type"] = "boolean"
+                field_data["values"].append(value)
+            elif isinstance(value, (int, float)):
+                field_data["type"] = "numeric"
+                field_data["values"].append(float(value))
+            elif isinstance(value, str):
+                # Try to detect if string is actually numeric or boolean
+                stripped = _strip_lower(value)
+                if stripped in ("true", "yes", "1"):
+                    field_data["type"] = "boolean"
+                    field_data["values"].append(True)
+                elif stripped in ("false", "no", "0"):
+                    field_data["type"] = "boolean"
+                    field_data["values"].append(False)
+                else:
+                    # Try numeric conversion
+                    try:
+                        num_val = float(value)
+                        field_data["type"] = "numeric"
+                        field_data["values"].append(num_val)
+                    except (ValueError, TypeError):
+                        # Keep as text (set-tracked so values stay unique and ordered)
+                        field_data["type"] = "text"
+                        if value not in field_data["seen"]:
+                            field_data["seen"].add(value)
+                            field_data["values"].append(value)
+
+
+    def _build_aggregated_product(product: _ProductAgg) -> Dict:
+        """Build final aggregated product with computed metrics."""
+
+        # Compute aggregated values from dynamic collection
+        aggregated_metrics = {}
+
+        for field, data in product.dynamic_values.items():
+            values = data.get("values", [])
+            value_type = data.get("type")
+
+            if not values:
+                continue
+
+            if value_type == "numeric":
+                # Average numeric values
+                avg = sum(values) / len(values)
+                # Round based on field name hints
+                if any(kw in field.lower() for kw in ["hour", "time", "duration", "wear"]):
+                    aggregated_metrics[field] = round(avg, 1)
+                elif any(kw in field.lower() for kw in ["score", "rating", "level"]):
+                    aggregated_metrics[field] = round(avg, 1)
+                elif any(kw in field.lower() for kw in ["price", "mrp", "cost"]):
+                    aggregated_metrics[field] = round(avg, 0)
+                else:
+                    aggregated_metrics[field] = round(avg, 2) if avg != int(avg) else int(avg)
+
+            elif value_type == "boolean":
+                # Majority vote (C-level count; falsy entries are exactly those == False)
+                true_count = len(values) - values.count(False)
+                aggregated_metrics[field] = true_count > len(values) / 2
+
+            elif value_type == "text":
+                # Combine unique text values (already deduplicated in order during collection)
+                unique_values = values
+                if len(unique_values) == 1:
+                    aggregated_metrics[field] = unique_values[0]
+                else:
+                    aggregated_metrics[field] = unique_values  # Keep as list for multiple values
+
+        # Get representative metadata from best item
+        best_metadata = product.best_item.get("metadata", {}) if product.best_item else {}
+
+        return {
+            "product": product.product_base_name,
+            "brand": product.brand,
+            "category": product.category,
+            "product_line": product.product_line,
+            "product_type": product.product_type,
+            "shades_available": product.shades_seen,
+            "shades_count": len(product.shades_seen),
+            "skus": product.skus_seen,
+            "sections_covered": product.sections_seen,
+            "relevance_score": round(product.best_score, 4),
+            "aggregated_metrics": aggregated_metrics,
+            "detailed_data": {
+                "full_name": best_metadata.get("full_name") or best_metadata.get("product_name"),
+                "sku": best_metadata.get("sku"),
+                "content_preview": (best_metadata.get("content") or "")[:500],  # Preview for context
+            },
+            "all_chunks": [  # Full content for Layer 2
+                {"score": score, "section": section, "content": content, "shade": shade}
+                for score, section, content, shade in zip(
+                    product.chunk_scores, product.chunk_sections, product.chunk_contents, product.chunk_shades
+                )
+            ],
+        }
+
+
+def get_unique_product_names(aggregated_products: List[Dict]) -> List[str]:
+    """Extract list of unique product names for web search validation."""
+    return [p.get("product", "") for p in aggregated_products 
+            if p.get("product") and p.get("product") != "Unknown Product"]
 
 
 # =============================================================================
@@ -1186,8 +1471,241 @@ CHANGED: query_domain + query_type → single "intent" field + special flags
 """
 
 
-def analyze_query_intent(query: str, session: SessionState, client: Anthropic) -> Dict[str, Any]:
-    """Use LLM to analyze query with new flattened intent structure."""
+class IntentCache:
+    """
+    Semantic cache for Layer 1 intent results.
+    
+    Keeps unit-normalized query embeddings in a fixed-size matrix. A lookup returns
+    the stored intent of the most similar query when cosine similarity is at least
+    `threshold` AND the context hash matches. The context includes the session id,
+    so entries are never shared between sessions. Oldest entries are overwritten
+    first (FIFO). Requires numpy.
+    """
+    
+    def __init__(self, max_entries: int = 1000, threshold: float = 0.95):
+        self.max_entries = max(1, max_entries)
+        self.threshold = threshold
+        self._vectors = None  # (max_entries, dim) float32 matrix, allocated on first add
+        self._contexts = np.zeros(self.max_entries, dtype=np.int64)
+        self._live = np.zeros(self.max_entries, dtype=bool)
+        self._entries: List[Optional[Tuple[str, Dict[str, Any]]]] = [None] * self.max_entries  # (session_id, intent)
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _normalize(vec: List[float]):
+        arr = np.asarray(vec, dtype=np.float32)
+        norm = float(np.linalg.norm(arr))
+        return arr / norm if norm else arr
+    
+    def lookup(self, vec: List[float], context_key: int, query: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the best cached intent for this query/context, or None."""
+        with self._lock:
+            if not self._size or self._vectors is None:
+                return None
+            candidates = self._live[:self._size] & (self._contexts[:self._size] == context_key)
+            if not candidates.any():
+                return None
+            sims = np.where(candidates, self._vectors[:self._size] @ self._normalize(vec), -np.inf)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            cached = self._entries[best][1]
+        
+        # Follow-ups are never stored, so the incoming wording is the query to search with
+        result = dict(cached)
+        result["resolved_query"] = query
+        return result
+    
+    def add(self, vec: List[float], context_key: int, session_id: str, result: Dict[str, Any]) -> None:
+        """Store an intent result, evicting the oldest entry when full."""
+        arr = self._normalize(vec)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != arr.shape[0]:
+                self._vectors = np.zeros((self.max_entries, arr.shape[0]), dtype=np.float32)
+                self._size = self._next = 0
+                self._live[:] = False
+            slot = self._next
+            self._vectors[slot] = arr
+            self._contexts[slot] = context_key
+            self._live[slot] = True
+            self._entries[slot] = (session_id, dict(result))
+            self._next = (slot + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+    
+    def discard_session(self, session_id: str) -> None:
+        """Drop every entry stored for a session."""
+        with self._lock:
+            for slot in range(self._size):
+                entry = self._entries[slot]
+                if entry is not None and entry[0] == session_id:
+                    self._live[slot] = False
+                    self._entries[slot] = None
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire after `ttl` seconds; oldest evicted past `maxsize`."""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            return item[1]
+    
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def discard_where(self, predicate: Callable[[Any], bool]) -> None:
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+
+# path → [mtime_ns, reads since last stat, parsed template]
+_prompt_template_cache: Dict[str, List[Any]] = {}
+
+
+def _load_prompt_template(path_str: str, parse: Callable[[str], Any]) -> Any:
+    """
+    Return parse(file text) for a prompt template, cached per path.
+    
+    The file is re-stat'ed every PROMPT_MTIME_CHECK_EVERY calls and re-read only
+    when its mtime changed. Raises FileNotFoundError like Path.read_text().
+    """
+    entry = _prompt_template_cache.get(path_str)
+    if entry is not None:
+        entry[1] += 1
+        if entry[1] < PROMPT_MTIME_CHECK_EVERY:
+            return entry[2]
+        entry[1] = 0
+        if os.stat(path_str).st_mtime_ns == entry[0]:
+            return entry[2]
+    
+    path = Path(path_str)
+    mtime_ns = path.stat().st_mtime_ns
+    parsed = parse(path.read_text(encoding="utf-8"))
+    _prompt_template_cache[path_str] = [mtime_ns, 0, parsed]
+    return parsed
+
+
+def _parse_layer1_template(raw_text: str) -> Tuple[str, str]:
+    """Strip optional triple quotes and split into (dynamic_header, static_instructions)."""
+    tpl_text = raw_text.strip()
+    if (tpl_text.startswith('"""') and tpl_text.endswith('"""')) or \
+       (tpl_text.startswith("'''") and tpl_text.endswith("'''")):
+        tpl_text = tpl_text[3:-3].strip()
+    return _split_layer1_template(tpl_text)
+
+
+# Intent fields returned by analyze_query_intent, with defaults for missing keys.
+# resolved_query defaults to the user's query (filled in per call).
+_INTENT_SCHEMA: Tuple[Tuple[str, Any], ...] = (
+    ("intent", "recommend"),
+    ("requires_retrieval", True),
+    ("requires_web_validation", False),
+    # NEW: Memory-based answering passthrough
+    ("answer_in_memory", False),
+    ("memory_answer", None),
+    ("is_brand_query", False),
+    ("is_ingredient_query", False),
+    ("is_price_query", False),
+    ("is_negative_query", False),
+    ("exclude_attributes", None),
+    ("is_followup", False),
+    ("has_ordinal", False),
+    ("needs_clarification", False),
+    ("clarification_type", None),
+    ("resolved_query", None),
+    ("detected_product", None),
+    ("detected_brand", None),
+    ("detected_category", None),
+    ("detected_ingredients", None),
+    ("comparison_entities", None),
+    ("comparison_attribute", None),
+    ("reasoning", ""),
+)
+
+# Markdown code fence around LLM JSON: body runs to the first closing fence (or end)
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*(.*?)\s*(?:```|\Z)", re.DOTALL)
+
+
+def _strip_json_fence(text: str) -> str:
+    """Return the JSON body of an LLM reply without surrounding ``` / ```json fences."""
+    text = text.strip()
+    match = _JSON_FENCE_RE.match(text)
+    if match:
+        return match.group(1)
+    return text[:-3].strip() if text.endswith("```") else text
+
+
+def _split_layer1_template(tpl_text: str) -> Tuple[str, str]:
+    """
+    Split the Layer 1 template into (dynamic_header, static_instructions).
+    
+    The header ends with the {query} line and holds every placeholder; the rest is
+    identical across calls, so it is sent as a cacheable system block. Returns
+    (tpl_text, "") when the template cannot be split cleanly.
+    """
+    marker = tpl_text.find("{query}")
+    line_end = tpl_text.find("\n", marker) if marker != -1 else -1
+    if line_end == -1:
+        return tpl_text, ""
+    try:
+        static = tpl_text[line_end + 1:].format().strip()  # unescape {{ }}
+    except (KeyError, IndexError, ValueError):
+        return tpl_text, ""
+    return tpl_text[:line_end].strip(), static
+
+
+_intent_cache: Optional[IntentCache] = (
+    IntentCache(config.INTENT_CACHE_MAX_ENTRIES, config.INTENT_CACHE_THRESHOLD)
+    if config.ENABLE_INTENT_CACHE and np is not None else None
+)
+_intent_ttl_cache: Optional[TTLCache] = (
+    TTLCache(INTENT_TTL_MAX_ENTRIES, INTENT_TTL_SECONDS) if config.ENABLE_INTENT_CACHE else None
+)
+
+
+# Intents with any of these set are not stored in the semantic cache
+_INTENT_UNCACHEABLE_FLAGS = ("answer_in_memory", "is_followup", "has_ordinal")
+
+
+def invalidate_intent_cache(session_id: str) -> None:
+    """Forget cached intent results for a session (e.g. after it is cleared)."""
+    if _intent_cache is not None:
+        _intent_cache.discard_session(session_id)
+    if _intent_ttl_cache is not None:
+        _intent_ttl_cache.discard_where(lambda key: key[0] == session_id)
+
+
+def analyze_query_intent(query: str, session: SessionState, client: Anthropic, query_embedding: Optional[Future] = None) -> Dict[str, Any]:
+    """Use LLM to analyze query with new flattened intent structure.
+    
+    `query_embedding` is an in-flight embedding of `query` (shared with speculative retrieval) for the semantic cache.
+    """
+    # Turn-scoped: follow-ups ("the second one", "is it vegan?") mean something else next turn
+    ttl_key = (session.session_id, session.load().get("turn_count", 0), query)
+    if _intent_ttl_cache is not None:
+        cached_intent = _intent_ttl_cache.get(ttl_key)
+        if cached_intent is not None:
+            logger.info("Intent: exact-repeat cache hit")
+            return dict(cached_intent)
+    
     session_summary = session.get_summary()
     
     list_context = ""
@@ -1208,15 +1726,27 @@ def analyze_query_intent(query: str, session: SessionState, client: Anthropic) -
     if memory_preview and len(memory_preview) > 2500:
         memory_preview = memory_preview[:2500] + "\n... (truncated)"
 
+    # Semantic cache: near-duplicate query in the same context → skip the LLM call.
+    # Scoped to this session and its memory files; otherwise keyed on slow-moving state only
+    # (the summary changes every turn and would never hit).
+    cache_vec: Optional[List[float]] = None
+    state = session.load()
+    cache_ctx = hash((session.session_id, state.get("current_product"), state.get("current_brand"),
+                      state.get("current_category"), list_context, memory_preview))
+    if _intent_cache is not None:
+        try:
+            cache_vec = query_embedding.result() if query_embedding is not None else embed_text(query)
+            cached = _intent_cache.lookup(cache_vec, cache_ctx, query) if cache_vec else None
+            if cached is not None:
+                logger.info("Intent: semantic cache hit")
+                return cached
+        except Exception as e:
+            logger.warning(f"Intent cache lookup failed: {e}")
+            cache_vec = None
+
     try:
-        tpl_path = Path(config.LAYER1_PROMPT_PATH)
-        tpl_text = tpl_path.read_text(encoding="utf-8").strip()
-        
-        if (tpl_text.startswith('"""') and tpl_text.endswith('"""')) or \
-           (tpl_text.startswith("'''") and tpl_text.endswith("'''")):
-            tpl_text = tpl_text[3:-3].strip()
-        
-        analysis_prompt = tpl_text.format(
+        tpl_header, static_instructions = _load_prompt_template(config.LAYER1_PROMPT_PATH, _parse_layer1_template)
+        analysis_prompt = tpl_header.format(
             session_summary=session_summary,
             list_context=list_context or "(none)",
             memory_preview=memory_preview or "(none)",
@@ -1229,61 +1759,48 @@ def analyze_query_intent(query: str, session: SessionState, client: Anthropic) -
         logger.error(f"Failed to load Layer 1 prompt: {e}")
         return _fallback_intent(query)
 
+    # Static instructions go in a cached system block; only the header varies per call
+    request_kwargs: Dict[str, Any] = {
+        "model": config.ROUTER_MODEL,
+        "max_tokens": 2000,
+        "temperature": 0.0,
+        "messages": [{"role": "user", "content": analysis_prompt}],
+        "betas": ["prompt-caching-2024-07-31"],
+    }
+    if static_instructions:
+        request_kwargs["system"] = [{"type": "text", "text": static_instructions, "cache_control": {"type": "ephemeral"}}]
+
+    # Echo the intent JSON as it streams only when someone can see it (TTY / debug)
+    echo_stream = config.DEBUG_INTENT_STREAM or (sys.stdout.isatty() and not config.STREAM_FINAL_ONLY)
+
     try:
         _start = time.perf_counter()
         
-        with client.messages.stream(
-            model=config.ROUTER_MODEL,
-            max_tokens=2000,
-            temperature=0.0,
-            messages=[{"role": "user", "content": analysis_prompt}],
-        ) as stream:
-            streamed_parts = []
-            for chunk in stream.text_stream:
-                print(chunk, end="", flush=True)
-                streamed_parts.append(chunk)
-            response = stream.get_final_message()
-        
-        print()
+        if echo_stream:
+            with client.beta.messages.stream(**request_kwargs) as stream:
+                for chunk in stream.text_stream:
+                    print(chunk, end="", flush=True)
+                response = stream.get_final_message()
+            print()
+        else:
+            response = client.beta.messages.create(**request_kwargs)
         
         logger.info(f"Intent analysis: {time.perf_counter() - _start:.2f}s")
         
-        result_text = response.content[0].text.strip() if response.content else "".join(streamed_parts).strip()
+        result_text = response.content[0].text.strip() if response.content else ""
         
-        if result_text.startswith("```"):
-            result_text = result_text.split("```")[1]
-            if result_text.startswith("json"):
-                result_text = result_text[4:]
-        if result_text.endswith("```"):
-            result_text = result_text[:-3]
+        result = _json_loads(_strip_json_fence(result_text))
         
-        result = json.loads(result_text.strip())
+        intent = {key: result.get(key, default) for key, default in _INTENT_SCHEMA}
+        intent["resolved_query"] = result.get("resolved_query", query)
         
-        return {
-            "intent": result.get("intent", "recommend"),
-            "requires_retrieval": result.get("requires_retrieval", True),
-            "requires_web_validation": result.get("requires_web_validation", False),
-            # NEW: Memory-based answering passthrough
-            "answer_in_memory": result.get("answer_in_memory", False),
-            "memory_answer": result.get("memory_answer"),
-            "is_brand_query": result.get("is_brand_query", False),
-            "is_ingredient_query": result.get("is_ingredient_query", False),
-            "is_price_query": result.get("is_price_query", False),
-            "is_negative_query": result.get("is_negative_query", False),
-            "exclude_attributes": result.get("exclude_attributes"),
-            "is_followup": result.get("is_followup", False),
-            "has_ordinal": result.get("has_ordinal", False),
-            "needs_clarification": result.get("needs_clarification", False),
-            "clarification_type": result.get("clarification_type"),
-            "resolved_query": result.get("resolved_query", query),
-            "detected_product": result.get("detected_product"),
-            "detected_brand": result.get("detected_brand"),
-            "detected_category": result.get("detected_category"),
-            "detected_ingredients": result.get("detected_ingredients"),
-            "comparison_entities": result.get("comparison_entities"),
-            "comparison_attribute": result.get("comparison_attribute"),
-            "reasoning": result.get("reasoning", ""),
-        }
+        # Memory answers and follow-up/ordinal resolutions depend on more than the wording; never reuse them
+        if _intent_cache is not None and cache_vec and not any(intent.get(k) for k in _INTENT_UNCACHEABLE_FLAGS):
+            _intent_cache.add(cache_vec, cache_ctx, session.session_id, intent)
+        # Don't pin an incomplete classification for repeats
+        if _intent_ttl_cache is not None and not intent.get("needs_clarification"):
+            _intent_ttl_cache.set(ttl_key, dict(intent))
+        return intent
         
     except json.JSONDecodeError as e:
         logger.warning(f"Intent JSON parse failed: {e}")
@@ -1295,15 +1812,10 @@ def analyze_query_intent(query: str, session: SessionState, client: Anthropic) -
 
 def _fallback_intent(query: str) -> Dict[str, Any]:
     """Fallback intent when analysis fails."""
-    return {
-        "intent": "recommend", "requires_retrieval": True, "requires_web_validation": False,
-        "is_brand_query": False, "is_ingredient_query": False, "is_price_query": False,
-        "is_negative_query": False, "exclude_attributes": None,
-        "is_followup": False, "has_ordinal": False, "needs_clarification": False,
-        "clarification_type": None, "resolved_query": query,
-        "detected_product": None, "detected_brand": None, "detected_category": None,
-        "detected_ingredients": None, "reasoning": "Fallback",
-    }
+    intent = {key: default for key, default in _INTENT_SCHEMA}
+    intent["resolved_query"] = query
+    intent["reasoning"] = "Fallback"
+    return intent
 
 
 
@@ -1317,6 +1829,9 @@ class MemoryToolHandler:
     def __init__(self, memory_dir: Path):
         self.memory_dir = memory_dir.resolve()
         self.memory_dir.mkdir(parents=True, exist_ok=True)
+        # Resolved once; per-call checks are pure string ops
+        self._memory_dir_str = str(self.memory_dir)
+        self._memory_root = os.path.join(self._memory_dir_str, "")
     
     def _validate_path(self, path_str: str) -> Tuple[bool, Path, str]:
         if not path_str:
@@ -1332,14 +1847,38 @@ class MemoryToolHandler:
         if ".." in path_str:
             return False, Path(), "Path traversal not allowed"
         
-        local_path = (self.memory_dir / relative_part).resolve() if relative_part else self.memory_dir
+        if not relative_part:
+            return True, self.memory_dir, ""
         
-        try:
-            local_path.relative_to(self.memory_dir)
-        except ValueError:
+        candidate = os.path.normpath(os.path.join(self._memory_dir_str, relative_part))
+        if candidate != self._memory_dir_str and not candidate.startswith(self._memory_root):
             return False, Path(), "Path escapes memory directory"
         
-        return True, local_path, ""
+        # memory_dir is already resolved, so only components below it can be symlinks;
+        # if any is, the string check above proves nothing: resolve and re-check
+        if self._has_symlink_below_root(candidate):
+            resolved = os.path.realpath(candidate)
+            if resolved != self._memory_dir_str and not resolved.startswith(self._memory_root):
+                return False, Path(), "Path escapes memory directory"
+            candidate = resolved
+        
+        return True, Path(candidate), ""
+    
+    def _has_symlink_below_root(self, candidate: str) -> bool:
+        current = candidate
+        while len(current) > len(self._memory_dir_str):
+            if os.path.islink(current):
+                return True
+            current = os.path.dirname(current)
+        return False
+    
+    @staticmethod
+    def _versioned_path(path: Path) -> Path:
+        """Sibling path for a new version: ms timestamp suffix, uuid fallback on collision."""
+        candidate = path.with_name(f"{path.stem}_{int(time.time() * 1000)}{path.suffix}")
+        if candidate.exists():
+            candidate = path.with_name(f"{path.stem}_{int(time.time() * 1000)}_{uuid.uuid4().hex[:6]}{path.suffix}")
+        return candidate
     
     def handle(self, tool_input: Dict[str, Any]) -> str:
         command = tool_input.get("command", "").lower()
@@ -1355,7 +1894,8 @@ class MemoryToolHandler:
         if not local_path.exists():
             return f"Path not found: {path_str}"
         if local_path.is_dir():
-            items = [f.name for f in sorted(local_path.iterdir()) if not f.name.startswith(".")]
+            with os.scandir(local_path) as it:
+                items = sorted(e.name for e in it if not e.name.startswith("."))
             return f"Files: {', '.join(items)}" if items else "Directory empty"
         try:
             content = local_path.read_text(encoding="utf-8")
@@ -1374,18 +1914,9 @@ class MemoryToolHandler:
         try:
             local_path.parent.mkdir(parents=True, exist_ok=True)
             # If file exists, auto-rename to avoid overwriting previous notes
-            target_path = local_path
-            if target_path.exists():
-                stem = target_path.stem
-                suffix = target_path.suffix
-                i = 1
-                while True:
-                    candidate = target_path.with_name(f"{stem}_{i}{suffix}")
-                    if not candidate.exists():
-                        target_path = candidate
-                        break
-                    i += 1
+            target_path = self._versioned_path(local_path) if local_path.exists() else local_path
             target_path.write_text(file_text, encoding="utf-8")
+            invalidate_memory_cache()
             # Return the actual created path as a normalized memory path
             rel = str(target_path.relative_to(self.memory_dir)) if target_path.is_relative_to(self.memory_dir) else target_path.name
             return f"Created: /memories/{rel}"
@@ -1407,15 +1938,9 @@ class MemoryToolHandler:
                 return "String not found"
             updated = content.replace(old_str, new_str, 1)
             # Version instead of overwriting: create a new file alongside original
-            stem = local_path.stem
-            suffix = local_path.suffix
-            i = 1
-            while True:
-                candidate = local_path.with_name(f"{stem}_{i}{suffix}")
-                if not candidate.exists():
-                    break
-                i += 1
+            candidate = self._versioned_path(local_path)
             candidate.write_text(updated, encoding="utf-8")
+            invalidate_memory_cache()
             # Return normalized path under /memories/
             rel = str(candidate.relative_to(self.memory_dir)) if candidate.is_relative_to(self.memory_dir) else candidate.name
             return f"Created: /memories/{rel}"
@@ -1434,6 +1959,7 @@ class MemoryToolHandler:
         try:
             if local_path.is_file():
                 local_path.unlink()
+                invalidate_memory_cache()
                 return f"Deleted: {path_str}"
             return "Not a file"
         except OSError as e:
@@ -1447,29 +1973,44 @@ class MemoryToolHandler:
 
 def _stream_with_filtering(stream, stream_callback: Optional[Callable[[str], None]]) -> Tuple[str, bool]:
     """Stream response while filtering meta markers."""
-    streamed_parts, preview_buffer = [], []
+    streamed_parts = []
+    preview, preview_len = io.StringIO(), 0
     printing_enabled, skip_initial_meta = False, True
+    # META_MARKER_PATTERN is ^-anchored: once the preview matches, it keeps matching as it grows,
+    # so a matched preview only needs re-checking when it crosses META_TEXT_THRESHOLD
+    preview_is_meta, suppressed = False, False
      
     for chunk in stream.text_stream:
         streamed_parts.append(chunk)
-        preview_buffer.append(chunk)
          
-        if isinstance(chunk, str) and chunk:
-            if not printing_enabled:
-                buf_txt = "".join(preview_buffer).strip()
-                if skip_initial_meta and META_MARKER_PATTERN.search(buf_txt):
-                    continue
-                skip_initial_meta = False
-                if buf_txt and (len(buf_txt) > META_TEXT_THRESHOLD or not META_MARKER_PATTERN.search(buf_txt)):
-                    clean_buf = strip_memory_preamble(buf_txt)
-                    if clean_buf:
-                        if stream_callback:
-                            stream_callback(clean_buf)
-                        printing_enabled = True
-                    preview_buffer.clear()
-            else:
+        if not (isinstance(chunk, str) and chunk):
+            continue
+        if printing_enabled:
+            if stream_callback:
+                stream_callback(chunk)
+            continue
+        if suppressed:
+            continue
+        
+        preview.write(chunk)
+        preview_len += len(chunk)
+        if preview_is_meta and preview_len <= META_TEXT_THRESHOLD:
+            continue
+        
+        buf_txt = preview.getvalue().strip()
+        if skip_initial_meta and _has_meta_marker(buf_txt):
+            suppressed = True
+            continue
+        skip_initial_meta = False
+        if buf_txt and (len(buf_txt) > META_TEXT_THRESHOLD or not _has_meta_marker(buf_txt)):
+            clean_buf = strip_memory_preamble(buf_txt)
+            if clean_buf:
                 if stream_callback:
-                    stream_callback(chunk)
+                    stream_callback(clean_buf)
+                printing_enabled = True
+            preview, preview_len, preview_is_meta = io.StringIO(), 0, False
+        elif buf_txt:
+            preview_is_meta = True
      
     return "".join(streamed_parts).strip(), printing_enabled
 
@@ -1487,24 +2028,40 @@ def _handle_tool_calls(tool_uses: List, memory_handler: MemoryToolHandler) -> Li
     return tool_results
 
 
-def _assemble_final_response(all_texts: List[str], last_text: str) -> str:
+# Sentence boundaries for duplicate detection across agent steps
+_SENTENCE_SPLIT_RE = re.compile(r"\.\s+|\n+")
+
+
+def _sentences(text: str) -> List[str]:
+    return [s for s in (p.strip().rstrip(".") for p in _SENTENCE_SPLIT_RE.split(text)) if s]
+
+
+def _assemble_final_response(all_texts: Iterable[str], last_text: str) -> str:
     """Assemble final response from collected meaningful texts."""
-    if all_texts:
-        final = all_texts[0]
-        for additional in all_texts[1:]:
-            if additional not in final and len(additional) > 100:
-                sentences = additional.split('. ')[:2]
-                if not any(s in final for s in sentences if len(s) > 20):
-                    final += "\n\n" + additional
-        return strip_memory_preamble(final.strip())
+    texts = iter(all_texts)
+    first = next(texts, None)
+    if first is not None:
+        final = [first]
+        seen_texts = {first}
+        seen_sentences = set(_sentences(first))
+        for additional in texts:
+            if additional in seen_texts or len(additional) <= 100:
+                continue
+            sentences = _sentences(additional)
+            if any(s in seen_sentences for s in sentences[:2] if len(s) > 20):
+                continue
+            final.append(additional)
+            seen_texts.add(additional)
+            seen_sentences.update(sentences)
+        return strip_memory_preamble("\n\n".join(final).strip())
     return strip_memory_preamble(extract_meaningful_text(last_text))
 
 
-def run_with_memory_tool(client: Anthropic, model: str, system_prompt: str, user_message: str,
+def run_with_memory_tool(client: Anthropic, model: str, system_prompt: Union[str, List[Dict[str, Any]]], user_message: str,
                          memory_handler: MemoryToolHandler, max_iterations: int = None,
                          temperature: float = 0.2, max_tokens: int = 8000,
                          stream_callback: Optional[Callable[[str], None]] = None) -> str:
-    """Run agentic loop with memory tool."""
+    """Run agentic loop with memory tool. system_prompt may be a string or prebuilt system blocks."""
     # Suppress incremental streaming in UI if final-only mode is enabled
     if config.STREAM_FINAL_ONLY:
         stream_callback = None
@@ -1514,29 +2071,43 @@ def run_with_memory_tool(client: Anthropic, model: str, system_prompt: str, user
     if not beta_iface or not getattr(beta_iface, "messages", None):
         raise RuntimeError("Anthropic beta API not available")
 
-    system_blocks = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    if isinstance(system_prompt, str):
+        system_blocks = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    else:
+        system_blocks = system_prompt
     messages = [{"role": "user", "content": user_message}]
 
-    all_meaningful_texts: List[str] = []
+    # Only the last few steps matter for the final answer; exact repeats are dropped on append
+    all_meaningful_texts: deque = deque(maxlen=config.MAX_MEMORY_AGENT_TEXTS)
+    seen_text_hashes: Set[bytes] = set()
     last_step_text = ""
     _total_start = time.perf_counter()
 
     for iter_idx in range(max_iterations):
         _api_start = time.perf_counter()
         
-        with beta_iface.messages.stream(
-            model=model, max_tokens=max_tokens, temperature=temperature,
-            system=system_blocks, messages=messages,
-            tools=[{"type": "memory_20250818", "name": "memory"}],
-            betas=["context-management-2025-06-27"],
-        ) as stream:
-            step_text, _ = _stream_with_filtering(stream, stream_callback)
-            response = stream.get_final_message()
+        # Read timeout bounds the gap between streamed chunks, so a stalled stream aborts instead of hanging
+        try:
+            with beta_iface.messages.stream(
+                model=model, max_tokens=max_tokens, temperature=temperature,
+                system=system_blocks, messages=messages,
+                tools=[{"type": "memory_20250818", "name": "memory"}],
+                betas=["context-management-2025-06-27"],
+                timeout=config.STREAM_IDLE_TIMEOUT,
+            ) as stream:
+                step_text, _ = _stream_with_filtering(stream, stream_callback)
+                response = stream.get_final_message()
+        except (APITimeoutError, httpx.TimeoutException, TimeoutError) as e:
+            logger.warning(f"Agent step {iter_idx + 1}: stream idle for {config.STREAM_IDLE_TIMEOUT}s, aborting ({e})")
+            return _assemble_final_response(all_meaningful_texts, last_step_text) or "Sorry, the response timed out. Please try again."
         
         step_text = strip_memory_preamble(step_text)
         last_step_text = step_text
         if step_text and not is_meta_only_text(step_text):
-            all_meaningful_texts.append(step_text)
+            text_hash = hashlib.blake2b(step_text.encode("utf-8"), digest_size=8).digest()
+            if text_hash not in seen_text_hashes:
+                seen_text_hashes.add(text_hash)
+                all_meaningful_texts.append(step_text)
 
         tool_uses = [b for b in response.content if getattr(b, "type", None) == "tool_use"]
         logger.info(f"Agent step {iter_idx + 1}: API={time.perf_counter() - _api_start:.2f}s, tools={len(tool_uses)}")
@@ -1566,16 +2137,69 @@ def run_with_memory_tool(client: Anthropic, model: str, system_prompt: str, user
 # =============================================================================
 
 
+# LRU of (model, text) -> embedding; tuples so cached vectors can't be mutated by callers
+_EMBED_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, ...]]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+
+def _embed_cache_get(key: Tuple[str, str]) -> Optional[Tuple[float, ...]]:
+    with _embed_cache_lock:
+        vec = _EMBED_CACHE.get(key)
+        if vec is not None:
+            _EMBED_CACHE.move_to_end(key)
+        return vec
+
+
+def _embed_cache_put(key: Tuple[str, str], vec: Tuple[float, ...]) -> None:
+    with _embed_cache_lock:
+        _EMBED_CACHE[key] = vec
+        _EMBED_CACHE.move_to_end(key)
+        while len(_EMBED_CACHE) > EMBED_CACHE_MAX_ENTRIES:
+            _EMBED_CACHE.popitem(last=False)
+
+
+# Shared pool for background I/O (speculative retrieval, per-entity compare queries);
+# long-lived so its threads and the clients' pooled connections stay warm across queries
+_IO_EXECUTOR = ThreadPoolExecutor(max_workers=COMPARE_MAX_WORKERS, thread_name_prefix="qna-io")
+
+
 def embed_text(text: str) -> List[float]:
-    """Generate embedding for text using OpenAI."""
+    """Generate embedding for text using OpenAI (LRU-cached)."""
     if not text:
         return []
-    if not config.OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY not configured")
     
-    client = OpenAI(api_key=config.OPENAI_API_KEY)
+    key = (config.EMBEDDING_MODEL, text)
+    cached = _embed_cache_get(key)
+    if cached is not None:
+        return list(cached)
+    
+    client = get_openai_client()
     resp = client.embeddings.create(model=config.EMBEDDING_MODEL, input=text)
-    return [float(v) for v in resp.data[0].embedding]
+    vec = tuple(float(v) for v in resp.data[0].embedding)
+    _embed_cache_put(key, vec)
+    return list(vec)
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Generate embeddings for several texts; only cache misses hit OpenAI, in one request."""
+    if not texts:
+        return []
+    
+    model = config.EMBEDDING_MODEL
+    vectors: List[Optional[Tuple[float, ...]]] = [_embed_cache_get((model, t)) for t in texts]
+    missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+    
+    if missing:
+        client = get_openai_client()
+        resp = client.embeddings.create(model=model, input=missing)
+        # The API returns one item per input; order by index to be safe
+        data = sorted(resp.data, key=lambda d: d.index)
+        fetched = {t: tuple(float(v) for v in d.embedding) for t, d in zip(missing, data)}
+        for t, vec in fetched.items():
+            _embed_cache_put((model, t), vec)
+        vectors = [v if v is not None else fetched[t] for t, v in zip(texts, vectors)]
+    
+    return [list(v) for v in vectors]
 
 
 def search_pinecone(query: str, top_k: int = PINECONE_TOP_K) -> List[Dict]:
@@ -1583,17 +2207,51 @@ def search_pinecone(query: str, top_k: int = PINECONE_TOP_K) -> List[Dict]:
     vec = embed_text(query)
     if not vec:
         return []
-    
+    return _query_pinecone(vec, top_k)
+
+
+def _search_with_embedding(embedding: Future, top_k: int = PINECONE_TOP_K) -> List[Dict]:
+    """Search Pinecone once an in-flight query embedding resolves."""
+    vec = embedding.result()
+    if not vec:
+        return []
+    return _query_pinecone(vec, top_k)
+
+
+def _query_pinecone(vec: List[float], top_k: int) -> List[Dict]:
+    """Query Pinecone with a precomputed embedding."""
     try:
         idx = get_pinecone_index()
         results = idx.query(vector=vec, top_k=top_k, include_values=False, include_metadata=True, namespace=config.PINECONE_NAMESPACE)
-        matches = getattr(results, "matches", []) or results.get("matches", [])
+        matches = getattr(results, "matches", None)
+        if matches is None:
+            matches = results.get("matches", [])
         return [{"product_id": getattr(m, "id", None) or m.get("id"), "score": getattr(m, "score", None) or m.get("score"), "metadata": getattr(m, "metadata", None) or m.get("metadata")} for m in matches]
     except Exception as e:
         logger.error(f"Pinecone search failed: {e}")
         return []
 
 
+# Index bookkeeping fields in hit metadata that carry no product information for the LLM
+_SLIM_DROP_METADATA_KEYS = frozenset({"parent_id", "section_index", "product_grouping_key", "_section_key", "values"})
+
+
+def _slim_hits(hits: List[Dict]) -> List[Dict]:
+    """Project raw hits to what Layer 2 needs: id, rounded score, non-empty product metadata."""
+    slim = []
+    for hit in hits:
+        md = hit.get("metadata") or {}
+        item = {
+            "product_id": hit.get("product_id"),
+            "score": round(hit["score"], 4) if isinstance(hit.get("score"), float) else hit.get("score"),
+            "metadata": {k: v for k, v in md.items() if k not in _SLIM_DROP_METADATA_KEYS and v is not None and v != ""},
+        }
+        if "_searched_entity" in hit:
+            item["_searched_entity"] = hit["_searched_entity"]
+        slim.append(item)
+    return slim
+
+
 def search_for_comparison(entities: List[str], base_query: str, top_k_per_entity: int = 15) -> List[Dict]:
     """
     Run separate searches for each comparison entity and merge results.
@@ -1603,14 +2261,21 @@ def search_for_comparison(entities: List[str], base_query: str, top_k_per_entity
     seen_ids: set = set()
     base_query = (base_query or "").strip()
     
+    searches: List[Tuple[str, str]] = []
     for entity in entities:
         entity = (entity or "").strip()
         if not entity:
             continue
         # Combine entity with any comparison attribute context
-        search_query = f"{entity} {base_query}".strip()
-        results = search_pinecone(search_query, top_k=top_k_per_entity)
-        
+        searches.append((entity, f"{entity} {base_query}".strip()))
+    if not searches:
+        return []
+    
+    # One batched embedding call for all entities, then fan out the Pinecone queries
+    vectors = embed_texts([q for _, q in searches])
+    results_per_entity = list(_IO_EXECUTOR.map(lambda v: _query_pinecone(v, top_k_per_entity), vectors))
+    
+    for (entity, _), results in zip(searches, results_per_entity):
         # Add results avoiding duplicates
         for item in results:
             pid = item.get("product_id")
@@ -1619,8 +2284,13 @@ def search_for_comparison(entities: List[str], base_query: str, top_k_per_entity
                 all_results.append(item)
                 seen_ids.add(pid)
     
-    # Sort by score
-    all_results.sort(key=lambda x: x.get("score", 0) or 0.0, reverse=True)
+    # Sort by score (stable, highest first)
+    if np is not None and len(all_results) >= NUMPY_SORT_MIN_ITEMS:
+        scores = np.fromiter((r.get("score") or 0.0 for r in all_results), dtype=np.float64, count=len(all_results))
+        order = np.argsort(-scores, kind="stable")
+        all_results = [all_results[i] for i in order]
+    else:
+        all_results.sort(key=lambda x: x.get("score", 0) or 0.0, reverse=True)
     return all_results
 
 
@@ -1672,12 +2342,75 @@ def parse_comparison_entities(text: str) -> List[str]:
 # MAIN PRODUCT QNA FUNCTION
 # =============================================================================
 
+@dataclass
+class UserMsg:
+    """Layer 2 user message. Optional fields still at their default are omitted from the payload."""
+    user_question: str
+    resolved_query: str
+    intent: str
+    unique_products_found: int
+    detected_product: Optional[str] = None
+    detected_brand: Optional[str] = None
+    is_followup: bool = False
+    is_price_query: bool = False
+    is_ingredient_query: bool = False
+    is_negative_query: bool = False
+    exclude_attributes: Optional[Any] = None
+    needs_clarification: bool = False
+    
+    def to_payload(self) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {}
+        for name, default in _USER_MSG_FIELDS:
+            value = getattr(self, name)
+            if default is MISSING or value != default:
+                payload[name] = value
+        return payload
+    
+    def to_json(self, pretty: bool = False) -> str:
+        return _json_dumps(self.to_payload(), pretty=pretty)
+
+
+_USER_MSG_FIELDS: Tuple[Tuple[str, Any], ...] = tuple((f.name, f.default) for f in fields(UserMsg))
+
+
+def _split_layer2_template(tpl_text: str) -> Tuple[str, str]:
+    """
+    Split the Layer 2 template into (static_prefix, dynamic_template).
+    
+    The template uses string.Template `$name` placeholders. Everything before the
+    line holding the first placeholder is identical across turns, so it is sent as
+    a cacheable system block.
+    """
+    match = next((m for m in string.Template.pattern.finditer(tpl_text) if m.group("named") or m.group("braced")), None)
+    split_at = tpl_text.rfind("\n", 0, match.start()) + 1 if match else len(tpl_text)
+    static = string.Template(tpl_text[:split_at]).safe_substitute().strip()  # unescape $$
+    return static, tpl_text[split_at:].strip()
+
+
+_RETRIEVED_CONTEXT_RE = re.compile(r"(?<!\$)\$(?:retrieved_context\b|\{retrieved_context\})")
+
+
+def _parse_layer2_template(raw_text: str) -> Tuple[str, Tuple[string.Template, ...]]:
+    """
+    Split the Layer 2 template into (static_prefix, dynamic_segments).
+    
+    The dynamic part is cut at each $retrieved_context so the (large) retrieved
+    context is joined in once per turn rather than substituted through the template.
+    """
+    static_prefix, dynamic_template = _split_layer2_template(raw_text.strip())
+    return static_prefix, tuple(string.Template(seg) for seg in _RETRIEVED_CONTEXT_RE.split(dynamic_template))
+
+
 def general_product_qna(query: str, category: Optional[str] = None, session_id: Optional[str] = None,
-                        stream_callback: Optional[Callable[[str], None]] = None) -> str:
+                        stream_callback: Optional[Callable[[str], None]] = None,
+                        session: Optional[SessionState] = None) -> str:
     """
     Main entry point for product Q&A.
     
     v3.2 FLOW: Validate → Intent → Pinecone(100) → Cohere(50) → Dedupe → Aggregate → Web → Layer 2
+    
+    Pass `session` to reuse a long-lived SessionState (e.g. one kept across Streamlit reruns);
+    otherwise one is created for `session_id`.
     """
     
     # STEP 1: Validate input
@@ -1690,175 +2423,211 @@ def general_product_qna(query: str, category: Optional[str] = None, session_id:
     client = get_anthropic_client()
     total_start = time.perf_counter()
     
-    sid = session_id or os.getenv("MEMORY_SESSION_ID") or "global"
-    session = SessionState(sid)
+    if session is None:
+        sid = session_id or os.getenv("MEMORY_SESSION_ID") or "global"
+        session = SessionState(sid)
     memory_handler = MemoryToolHandler(session.memory_dir)
+    # One state read per query (re-read only if another process changed the file)
+    state = session.snapshot()
     
-    logger.info(f"Query: {query}")
-    
-    # STEP 3: Analyze Intent
-    logger.info("Analyzing intent...")
-    intent = analyze_query_intent(query, session, client)
-    
-    intent_type = intent.get("intent", "recommend")
-    requires_retrieval = intent.get("requires_retrieval", True)
-    requires_web_validation = intent.get("requires_web_validation", False)
-    
-    logger.info(f"Intent: {intent_type}, retrieval={requires_retrieval}, web={requires_web_validation}")
-
-    # NEW: Memory-based answering short-circuit
-    answer_in_memory = intent.get("answer_in_memory", False)
-    memory_answer = intent.get("memory_answer")
-    if answer_in_memory and memory_answer:
-        logger.info("✓ Answer found in memory - skipping retrieval and Layer 2")
-        # Update session state
-        session.update(
-            current_product=intent.get("detected_product"),
-            current_brand=intent.get("detected_brand"),
-            current_category=intent.get("detected_category") or category,
-            last_query=query,
-            last_answer_preview=(memory_answer or "")[:200],
-        )
-        # Stream the answer if callback provided
-        if stream_callback:
-            try:
-                stream_callback(memory_answer)
-            except Exception:
-                pass
-        logger.info(f"Total: {time.perf_counter() - total_start:.2f}s (from memory)")
-        return memory_answer
-    
-    # STEP 4: Handle Off-Topic
-    if intent_type == "off_topic":
-        response = get_off_topic_response(query)
-        session.update(last_query=query, last_answer_preview=response[:200])
-        return response
-    
-    # STEP 5: Retrieval Pipeline
-    retrieved, aggregated_products = [], []
-    
-    if requires_retrieval:
-        search_query = intent.get("resolved_query", query)
+    # Session changes are collected here and written once, whichever way the function exits
+    pending: Dict[str, Any] = {}
+    try:
+        logger.info(f"Query: {query}")
+        
+        # STEP 3: Analyze Intent
+        # Embed the raw query once: the intent cache and the speculative search share it.
+        # The search runs meanwhile and is used only if intent doesn't change the search.
+        query_embedding = _IO_EXECUTOR.submit(embed_text, query) if (config.ENABLE_SPECULATIVE_RETRIEVAL or _intent_cache is not None) else None
+        speculative_search = _IO_EXECUTOR.submit(_search_with_embedding, query_embedding, PINECONE_TOP_K) if config.ENABLE_SPECULATIVE_RETRIEVAL else None
+        logger.info("Analyzing intent...")
+        try:
+            intent = analyze_query_intent(query, session, client, query_embedding=query_embedding)
+        except BaseException:
+            if speculative_search is not None:
+                speculative_search.cancel()
+            raise
+        
+        intent_type = intent.get("intent", "recommend")
+        requires_retrieval = intent.get("requires_retrieval", True)
+        requires_web_validation = intent.get("requires_web_validation", False)
+        
+        logger.info(f"Intent: {intent_type}, retrieval={requires_retrieval}, web={requires_web_validation}")
+
+        # NEW: Memory-based answering short-circuit
+        answer_in_memory = intent.get("answer_in_memory", False)
+        memory_answer = intent.get("memory_answer")
+        if answer_in_memory and memory_answer:
+            logger.info("✓ Answer found in memory - skipping retrieval and Layer 2")
+            # Update session state
+            pending.update(
+                current_product=intent.get("detected_product"),
+                current_brand=intent.get("detected_brand"),
+                current_category=intent.get("detected_category") or category,
+                last_query=query,
+                last_answer_preview=(memory_answer or "")[:200],
+            )
+            # Stream the answer if callback provided
+            if stream_callback:
+                try:
+                    stream_callback(memory_answer)
+                except Exception:
+                    pass
+            logger.info(f"Total: {time.perf_counter() - total_start:.2f}s (from memory)")
+            return memory_answer
+        
+        # STEP 4: Handle Off-Topic
+        if intent_type == "off_topic":
+            response = get_off_topic_response(query)
+            pending.update(last_query=query, last_answer_preview=response[:200])
+            return response
+        
+        # STEP 5: Retrieval Pipeline
+        retrieved, aggregated_products = [], []
+        
+        if requires_retrieval:
+            search_query = intent.get("resolved_query", query)
+            
+            if intent.get("is_brand_query") and intent.get("detected_brand"):
+                brand = intent["detected_brand"]
+                if brand.lower() not in search_query.lower():
+                    search_query = f"{brand} {search_query}"
+            
+            # 5a. Pinecone Search
+            comparison_entities = intent.get("comparison_entities") or []
+            comparison_attribute = intent.get("comparison_attribute", "")
+            if intent_type == "compare" and len(comparison_entities) >= 2:
+                per_k = max(1, config.COMPARE_TOP_K_PER_ENTITY)
+                logger.info(f"Pinecone (compare): entities={comparison_entities}, attr='{comparison_attribute}', per_k={per_k}")
+                retrieved = search_for_comparison(comparison_entities, comparison_attribute, top_k_per_entity=per_k)
+                logger.info(f"Pinecone (compare): {len(retrieved)} merged results")
+            elif speculative_search is not None and search_query == query:
+                logger.info(f"Pinecone: '{search_query}' (top {PINECONE_TOP_K}, speculative)")
+                retrieved = speculative_search.result()
+                speculative_search = None
+                logger.info(f"Pinecone: {len(retrieved)} results")
+            else:
+                logger.info(f"Pinecone: '{search_query}' (top {PINECONE_TOP_K})")
+                retrieved = search_pinecone(search_query, top_k=PINECONE_TOP_K)
+                logger.info(f"Pinecone: {len(retrieved)} results")
+            
+            # 5b. Cohere rerank (disabled)
+            # retrieved = rerank_with_cohere(search_query, retrieved, top_n=COHERE_TOP_N)
+            if DISABLE_GROUPING_AND_AGGREGATION:
+                # Bypass dedupe/aggregation — pass slimmed raw Pinecone docs to Layer 2
+                aggregated_products = _slim_hits(retrieved)
+            else:
+                # 5c-5d. Dedupe chunks per product, then aggregate into product-level records
+                retrieved = dedupe_by_product(retrieved, max_chunks_per_product=MAX_CHUNKS_PER_PRODUCT)
+                aggregated_products = aggregate_products_for_display(retrieved)[:MAX_PRODUCTS_FOR_LLM]
+                logger.info(f"Dedupe/aggregate: {len(retrieved)} chunks -> {len(aggregated_products)} products")
+        
+        if speculative_search is not None:
+            speculative_search.cancel()
         
-        if intent.get("is_brand_query") and intent.get("detected_brand"):
-            brand = intent["detected_brand"]
-            if brand.lower() not in search_query.lower():
-                search_query = f"{brand} {search_query}"
+        # STEP 6: Web Validation
+        web_validation_context = ""
+        # if requires_web_validation and aggregated_products and intent_type == "recommend":
+        #     product_names = get_unique_product_names(aggregated_products)
+        #     web_validation_context = perform_web_search_validation(query, product_names, client)
         
-        # 5a. Pinecone Search
-        comparison_entities = intent.get("comparison_entities") or []
-        comparison_attribute = intent.get("comparison_attribute", "")
-        if intent_type == "compare" and len(comparison_entities) >= 2:
-            per_k = max(1, config.COMPARE_TOP_K_PER_ENTITY)
-            logger.info(f"Pinecone (compare): entities={comparison_entities}, attr='{comparison_attribute}', per_k={per_k}")
-            retrieved = search_for_comparison(comparison_entities, comparison_attribute, top_k_per_entity=per_k)
-            logger.info(f"Pinecone (compare): {len(retrieved)} merged results")
+        # STEP 7: Check for empty results
+        if requires_retrieval and not aggregated_products:
+            return "I couldn't find relevant products. Could you try rephrasing?"
+        
+        # STEP 8: Build Layer 2 Prompt
+        try:
+            static_prefix, dynamic_segments = _load_prompt_template(config.LAYER2_PROMPT_PATH, _parse_layer2_template)
+        except FileNotFoundError:
+            logger.error("Layer 2 prompt not found at %s", config.LAYER2_PROMPT_PATH)
+            raise
+        except Exception as e:
+            logger.error(f"Failed to load Layer 2 prompt: {e}")
+            raise
+        
+        if aggregated_products:
+            # One compact JSON record per line
+            retrieved_context = "\n".join(_json_dumps(p) for p in aggregated_products)
         else:
-            logger.info(f"Pinecone: '{search_query}' (top {PINECONE_TOP_K})")
-            retrieved = search_pinecone(search_query, top_k=PINECONE_TOP_K)
-            logger.info(f"Pinecone: {len(retrieved)} results")
+            retrieved_context = "(no products)"
         
-        # 5b-5d. Bypass rerank/dedupe/aggregation — pass raw Pinecone docs to Layer 2
-        # retrieved = rerank_with_cohere(search_query, retrieved, top_n=COHERE_TOP_N)
-        # retrieved = dedupe_by_product(retrieved, max_chunks_per_product=MAX_CHUNKS_PER_PRODUCT)
-        # aggregated_products = aggregate_products_for_display(retrieved)[:MAX_PRODUCTS_FOR_LLM]
-        aggregated_products = retrieved
-    
-    # STEP 6: Web Validation
-    web_validation_context = ""
-    # if requires_web_validation and aggregated_products and intent_type == "recommend":
-    #     product_names = get_unique_product_names(aggregated_products)
-    #     web_validation_context = perform_web_search_validation(query, product_names, client)
-    
-    # STEP 7: Check for empty results
-    if requires_retrieval and not aggregated_products:
-        return "I couldn't find relevant products. Could you try rephrasing?"
-    
-    # STEP 8: Build Layer 2 Prompt
-    try:
-        base_prompt = Path(config.LAYER2_PROMPT_PATH).read_text().strip()
-    except FileNotFoundError:
-        logger.error("Layer 2 prompt not found at %s", config.LAYER2_PROMPT_PATH)
-        raise
-    except Exception as e:
-        logger.error(f"Failed to load Layer 2 prompt: {e}")
-        raise
-    
-    if aggregated_products:
-        # Send raw Pinecone results directly to Layer 2
-        retrieved_context = json.dumps(aggregated_products, indent=2, ensure_ascii=False)
-    else:
-        retrieved_context = "(no products)"
-    
-    try:
-        base_prompt = base_prompt.format(
-            intent=intent_type, requires_retrieval=requires_retrieval, requires_web_validation=requires_web_validation,
-            is_brand_query=intent.get("is_brand_query", False), is_ingredient_query=intent.get("is_ingredient_query", False),
-            is_price_query=intent.get("is_price_query", False), is_negative_query=intent.get("is_negative_query", False),
-            needs_clarification=intent.get("needs_clarification", False),
-            clarification_type=intent.get("clarification_type"),
-            retrieved_context=retrieved_context, web_search_results=web_validation_context or "(none)",
-            session_summary=session.get_summary(),
-        )
-    except KeyError as e:
-        logger.warning(f"Missing placeholder: {e}")
-    
-    turn_count = session.load().get("turn_count", 0) + 1
-    system_prompt = f"""{base_prompt}
+        session_summary = session.get_summary()
+        values = {
+            "intent": intent_type, "requires_retrieval": requires_retrieval, "requires_web_validation": requires_web_validation,
+            "is_brand_query": intent.get("is_brand_query", False), "is_ingredient_query": intent.get("is_ingredient_query", False),
+            "is_price_query": intent.get("is_price_query", False), "is_negative_query": intent.get("is_negative_query", False),
+            "needs_clarification": intent.get("needs_clarification", False),
+            "clarification_type": intent.get("clarification_type"),
+            "web_search_results": web_validation_context or "(none)",
+            "session_summary": session_summary,
+        }
+        # safe_substitute leaves unknown $placeholders in place instead of raising
+        dynamic_prompt = retrieved_context.join(seg.safe_substitute(values) for seg in dynamic_segments)
+        
+        turn_count = state.get("turn_count", 0) + 1
+        # Cache breakpoint after the static template prefix; everything else keeps the original
+        # prompt order. The prefix is only cached when it meets the model's minimum cacheable length.
+        system_blocks: List[Dict[str, Any]] = []
+        if static_prefix:
+            system_blocks.append({"type": "text", "text": static_prefix, "cache_control": {"type": "ephemeral"}})
+        system_blocks.append({"type": "text", "text": f"""{dynamic_prompt}
 
 CRITICAL: Start with actual answer. No memory announcements.
 
 PRE-LOADED MEMORY: {session.get_memory_files_content() or "(empty)"}
-SESSION: {session.get_summary()}
-Turn: {turn_count}"""
-
-    user_msg = json.dumps({
-        "user_question": query, "resolved_query": intent.get("resolved_query", query),
-        "detected_product": intent.get("detected_product"), "detected_brand": intent.get("detected_brand"),
-        "is_followup": intent.get("is_followup", False), "intent": intent_type,
-        "is_price_query": intent.get("is_price_query", False), "is_ingredient_query": intent.get("is_ingredient_query", False),
-        "is_negative_query": intent.get("is_negative_query", False),
-        "exclude_attributes": intent.get("exclude_attributes"),
-        "needs_clarification": intent.get("needs_clarification", False),
-        "unique_products_found": len(aggregated_products),
-    }, indent=2)
-
-    # STEP 9: Generate Answer
-    logger.info("Generating answer...")
-    answer = run_with_memory_tool(client=client, model=config.QNA_MODEL, system_prompt=system_prompt,
-                                   user_message=user_msg, memory_handler=memory_handler, stream_callback=stream_callback)
-    
-    answer = strip_memory_preamble(answer.strip())
-    
-    if not answer:
-        answer = "I found products but couldn't formulate a clear answer. Please try rephrasing."
-    
-    # STEP 10: Update Session
-    product_name = intent.get("detected_product")
-    brand_name = intent.get("detected_brand")
-    
-    if not product_name and aggregated_products:
-        if len(aggregated_products) > 1:
-            product_name = f"List: {len(aggregated_products)} products"
-        else:
-            # Robust handling for raw Pinecone items
-            first = aggregated_products[0]
-            if isinstance(first, dict):
-                # Try aggregated keys first, then raw metadata
-                product_name = first.get("product_base_name")
-                brand_name = brand_name or first.get("brand")
-                if not product_name:
-                    md = first.get("metadata", {}) or {}
-                    product_name = md.get("product_name") or md.get("full_name") or md.get("title")
-                    brand_name = brand_name or md.get("brand")
-    
-    session.update(current_product=product_name, current_brand=brand_name,
-                   current_category=intent.get("detected_category") or category,
-                   last_query=query, last_answer_preview=answer[:200])
-    
-    logger.info(f"Total: {time.perf_counter() - total_start:.2f}s")
-    
-    return answer
+SESSION: {session_summary}
+Turn: {turn_count}"""})
+
+        user_payload = UserMsg(
+            user_question=query, resolved_query=intent.get("resolved_query", query),
+            detected_product=intent.get("detected_product"), detected_brand=intent.get("detected_brand"),
+            is_followup=intent.get("is_followup", False), intent=intent_type,
+            is_price_query=intent.get("is_price_query", False), is_ingredient_query=intent.get("is_ingredient_query", False),
+            is_negative_query=intent.get("is_negative_query", False),
+            exclude_attributes=intent.get("exclude_attributes"),
+            needs_clarification=intent.get("needs_clarification", False),
+            unique_products_found=len(aggregated_products),
+        )
+        if config.DEBUG_MODE:
+            logger.info(f"Layer 2 user message:\n{user_payload.to_json(pretty=True)}")
+        # Always compact on the wire so debug runs send the same bytes as production
+        user_msg = user_payload.to_json()
+
+        # STEP 9: Generate Answer
+        logger.info("Generating answer...")
+        answer = run_with_memory_tool(client=client, model=config.QNA_MODEL, system_prompt=system_blocks,
+                                       user_message=user_msg, memory_handler=memory_handler, stream_callback=stream_callback)
+        
+        answer = strip_memory_preamble(answer.strip())
+        
+        if not answer:
+            answer = "I found products but couldn't formulate a clear answer. Please try rephrasing."
+        
+        # STEP 10: Update Session
+        product_name = intent.get("detected_product")
+        brand_name = intent.get("detected_brand")
+        
+        if not product_name and aggregated_products:
+            if len(aggregated_products) > 1:
+                product_name = f"List: {len(aggregated_products)} products"
+            else:
+                # Aggregated records carry product/brand; slim hits carry them in metadata
+                first = aggregated_products[0]
+                if isinstance(first, dict):
+                    md = first.get("metadata") or {}
+                    product_name = first.get("product") or md.get("product_name") or md.get("full_name") or md.get("title")
+                    brand_name = brand_name or first.get("brand") or md.get("brand")
+        
+        pending.update(current_product=product_name, current_brand=brand_name,
+                       current_category=intent.get("detected_category") or category,
+                       last_query=query, last_answer_preview=answer[:200])
+        
+        logger.info(f"Total: {time.perf_counter() - total_start:.2f}s")
+        
+        return answer
+    finally:
+        if pending:
+            session.update(**pending)
 
 
 # =============================================================================
@@ -1894,12 +2663,7 @@ if __name__ == "__main__":
         
         if cmd == "reset":
             session.clear()
-            for f in session.memory_dir.iterdir():
-                if f.is_file() and not f.name.startswith("."):
-                    try:
-                        f.unlink()
-                    except:
-                        pass
+            session.clear_memory_files()
             print("✔ Cleared.")
             continue
         
@@ -1918,7 +2682,7 @@ if __name__ == "__main__":
                 print(c, end="", flush=True)
             
             print("\n🤖 Assistant: ", end="", flush=True)
-            response = general_product_qna(query=user_input, session_id="cli_session", stream_callback=on_chunk)
+            response = general_product_qna(query=user_input, session_id="cli_session", stream_callback=on_chunk, session=session)
             print()
         except Exception as e:
             logger.error(f"Error: {e}")
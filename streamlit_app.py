@@ -1,4 +1,6 @@
 import os
+import queue
+import threading
 from pathlib import Path
 import uuid
 
@@ -8,8 +10,9 @@ from dotenv import load_dotenv
 # Load .env BEFORE importing modules that read environment at import time
 load_dotenv(dotenv_path=Path(__file__).parent / ".env", override=False)
 
-# Map Streamlit Cloud secrets into environment vars (if provided) BEFORE imports that read os.getenv
-for key in (
+# Map Streamlit Cloud secrets into environment vars (if provided) BEFORE imports that read os.getenv.
+# Streamlit re-runs this script on every interaction, so do it once per browser session.
+SECRET_KEYS = (
     "PINECONE_API_KEY",
     "PINECONE_INDEX",
     "PINECONE_INDEX_NAME",
@@ -18,20 +21,51 @@ for key in (
     "OPENAI_API_KEY",
     "OPENAI_EMBEDDING_MODEL",
     "MEMORY_SESSION_ID",
-):
+)
+if "_secrets_bootstrapped" not in st.session_state:
     try:
-        if key in st.secrets and not os.getenv(key):
-            val = st.secrets.get(key)
-            if val is not None:
-                os.environ[key] = str(val)
+        secrets = dict(st.secrets)  # parses secrets.toml once
     except Exception:
         # Safe on local runs without st.secrets
-        pass
+        secrets = {}
+    for key in SECRET_KEYS:
+        val = secrets.get(key)
+        if val is not None and not os.getenv(key):
+            os.environ[key] = str(val)
+    st.session_state["_secrets_bootstrapped"] = True
 
 # Local imports (now env vars are available)
 from product_tools_optimized_updated import general_product_qna, SessionState
 
 APP_TITLE = "Beauty Assistant"
+# Marks the end of a streamed answer on the chunk queue
+_STREAM_DONE = object()
+# Seconds to wait for a cancelled backend run to exit; it only sees the cancel flag at its next chunk
+BACKEND_JOIN_TIMEOUT = 15.0
+
+
+class _StreamCancelled(Exception):
+    """Raised from the stream callback to abort a backend run superseded by a newer submit."""
+
+
+def _stop_backend_worker() -> bool:
+    """
+    Cancel the previous backend run of this browser session and wait (bounded) for it to exit.
+    
+    A submit or reset mid-stream reruns the script and abandons that worker; it must be gone
+    before anything else touches the same SessionState and memory files. Returns False if it
+    is still running after BACKEND_JOIN_TIMEOUT.
+    """
+    stale_cancel = st.session_state.get("_backend_cancel")
+    if stale_cancel is not None:
+        stale_cancel.set()
+    stale_worker = st.session_state.get("_backend_worker")
+    if stale_worker is not None:
+        stale_worker.join(timeout=BACKEND_JOIN_TIMEOUT)
+        if stale_worker.is_alive():
+            return False
+        st.session_state["_backend_worker"] = None
+    return True
 
 # --- Sidebar ---
 st.set_page_config(page_title=APP_TITLE, page_icon="🤖", layout="wide")
@@ -42,12 +76,16 @@ if "session_id" not in st.session_state:
     st.session_state["session_id"] = f"user_{uuid.uuid4().hex[:8]}"
 session_id = st.session_state["session_id"]
 
+# Keep one SessionState per browser session so its caches survive reruns
+sess = st.session_state.get("_session")
+if sess is None or sess.session_id != session_id:
+    sess = SessionState(session_id)
+    st.session_state["_session"] = sess
+
 with st.sidebar:
     st.header("Session")
     st.caption(f"Your session: `{session_id}`")
 
-    sess = SessionState(session_id)
-
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Show Context"):
@@ -56,18 +94,16 @@ with st.sidebar:
         
     with col2:
         if st.button("Reset Session"):
-            # Clear python state and memory files (similar to CLI reset)
-            sess.clear()
-            for f in sess.memory_dir.iterdir():
-                if f.is_file() and not f.name.startswith("."):
-                    try:
-                        f.unlink()
-                    except Exception:
-                        pass
-            st.session_state["messages"] = []
-            st.session_state["context_summary"] = "(cleared)"
-            st.success("Session and memory cleared.")
-            st.rerun()
+            if not _stop_backend_worker():
+                st.warning("The previous answer is still finishing. Please try again in a moment.")
+            else:
+                # Clear python state and memory files (similar to CLI reset)
+                sess.clear()
+                sess.clear_memory_files()
+                st.session_state["messages"] = []
+                st.session_state["context_summary"] = "(cleared)"
+                st.success("Session and memory cleared.")
+                st.rerun()
 
     # Context display
     st.divider()
@@ -98,6 +134,9 @@ user_query = st.chat_input("Ask something...", key="chat_input")
 # 3) On submit, append the user turn and stream the assistant reply live
 if user_query and user_query.strip():
     user_text = user_query.strip()
+    if not _stop_backend_worker():
+        st.warning("The previous answer is still finishing. Please resend your question in a moment.")
+        st.stop()
     # Append and render the new user message immediately
     st.session_state["messages"].append({"role": "user", "content": user_text})
     st.chat_message("user").markdown(user_text)
@@ -105,23 +144,49 @@ if user_query and user_query.strip():
     # Prepare a streaming placeholder for the assistant
     assistant_box = st.chat_message("assistant")
     stream_placeholder = assistant_box.empty()
-    streamed_parts: list[str] = []
-
-    def _on_chunk(chunk: str):
-        if not isinstance(chunk, str) or not chunk:
-            return
-        streamed_parts.append(chunk)
-        stream_placeholder.markdown("".join(streamed_parts))
 
-    # Call backend with streaming callback
+    # Run the backend on a worker thread: its stream callback only enqueues chunks, so UI
+    # rendering (done here on the script thread) never stalls reading the model's stream
+    chunk_queue: queue.SimpleQueue = queue.SimpleQueue()
+    result: dict = {}
+
+    cancel = threading.Event()
+
+    def _on_chunk(chunk):
+        if cancel.is_set():
+            raise _StreamCancelled()
+        chunk_queue.put(chunk)
+
+    def _run_backend():
+        try:
+            result["answer"] = general_product_qna(
+                query=user_text,
+                session_id=session_id,
+                stream_callback=_on_chunk,
+                session=sess,
+            )
+        except Exception as e:
+            result["answer"] = f"[ERROR] {e}"
+        finally:
+            chunk_queue.put(_STREAM_DONE)
+
+    def _stream_chunks():
+        for chunk in iter(chunk_queue.get, _STREAM_DONE):
+            if isinstance(chunk, str) and chunk:
+                yield chunk
+
+    worker = threading.Thread(target=_run_backend, daemon=True)
+    st.session_state["_backend_cancel"] = cancel
+    st.session_state["_backend_worker"] = worker
+    worker.start()
     try:
-        final_answer = general_product_qna(
-            query=user_text,
-            session_id=session_id,
-            stream_callback=_on_chunk,
-        )
-    except Exception as e:
-        final_answer = f"[ERROR] {e}"
+        with stream_placeholder.container():
+            st.write_stream(_stream_chunks())
+    finally:
+        # Interrupted by a rerun: stop the backend at its next chunk
+        cancel.set()
+    worker.join()
+    final_answer = result.get("answer", "")
 
     # Ensure final text is displayed and persist it in history
     stream_placeholder.markdown(final_answer)